@@ -0,0 +1,24 @@
+"""Session revision
+
+Revision ID: 7b2e94d1c3a8
+Revises: 3a9d0c6e71f5
+Create Date: 2026-10-18 15:12:47.218305
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '7b2e94d1c3a8'
+down_revision = '3a9d0c6e71f5'
+branch_labels = None
+depends_on = None
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.execute("INSERT INTO `revision` (`name`, `revision`) VALUES ('session', '0')")
+
+
+def downgrade():
+    op.execute("DELETE FROM `revision` WHERE `name` = 'session'")
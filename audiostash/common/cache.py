@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """ Simple dict-like cache that drops the least recently used entries when it grows past its capacity. """
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self._data = OrderedDict()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def get(self, key, default=None):
+        try:
+            value = self._data.pop(key)
+        except KeyError:
+            return default
+        self._data[key] = value
+        return value
+
+    def put(self, key, value):
+        self._data.pop(key, None)
+        self._data[key] = value
+        while len(self._data) > self.capacity:
+            self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        return self._data.pop(key, default)
+
+    def clear(self):
+        self._data.clear()
+
+
+class ByteLRUCache(LRUCache):
+    """ LRU cache of byte strings, limited by their total length instead of their number. """
+    def __init__(self, capacity):
+        super(ByteLRUCache, self).__init__(capacity)
+        self.size = 0
+
+    def put(self, key, value):
+        self.pop(key)
+        if len(value) > self.capacity:
+            return
+        self._data[key] = value
+        self.size += len(value)
+        while self.size > self.capacity:
+            old_key, old_value = self._data.popitem(last=False)
+            self.size -= len(old_value)
+
+    def pop(self, key, default=None):
+        value = self._data.pop(key, None)
+        if value is None:
+            return default
+        self.size -= len(value)
+        return value
+
+    def clear(self):
+        self._data.clear()
+        self.size = 0
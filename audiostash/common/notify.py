@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+
+import os
+import errno
+import socket
+import logging
+
+from audiostash import settings
+
+log = logging.getLogger(__name__)
+
+# Path of the socket this process listens on, if any. Our own changes don't need a datagram.
+_own_path = None
+
+
+def _enabled():
+    return settings.NOTIFY_SOCKET_DIRECTORY and hasattr(socket, 'AF_UNIX')
+
+
+def bind(name):
+    """
+    Creates a non-blocking datagram socket for receiving change notifications from other processes.
+    Returns None if notifications are not available. The caller should read everything from the
+    socket when it becomes readable, and then check the database for changes.
+    """
+    global _own_path
+    if not _enabled():
+        return None
+    directory = settings.NOTIFY_SOCKET_DIRECTORY
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    path = os.path.join(directory, "{}-{}.sock".format(name, os.getpid()))
+    if os.path.exists(path):
+        os.unlink(path)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    sock.setblocking(0)
+    sock.bind(path)
+    _own_path = path
+    return sock
+
+
+def unbind(sock):
+    """ Closes the socket and removes it, so that nobody tries to notify it any more """
+    global _own_path
+    sock.close()
+    if _own_path:
+        try:
+            os.unlink(_own_path)
+        except OSError:
+            pass
+        _own_path = None
+
+
+def publish():
+    """
+    Tells all listening processes that the table revisions have changed. The message carries no data;
+    the receivers read the revisions from the database. Never blocks, and never fails the caller.
+    """
+    if not _enabled():
+        return
+    directory = settings.NOTIFY_SOCKET_DIRECTORY
+    try:
+        names = os.listdir(directory)
+    except OSError:
+        return
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    sock.setblocking(0)
+    try:
+        for name in names:
+            path = os.path.join(directory, name)
+            if not name.endswith('.sock') or path == _own_path:
+                continue
+            try:
+                sock.sendto(b'changed', path)
+            except socket.error as e:
+                if e.errno == errno.ECONNREFUSED:
+                    # Nobody is listening; left behind by a process that didn't exit cleanly.
+                    log.debug(u"Removing stale notification socket %s.", path)
+                    try:
+                        os.unlink(path)
+                    except OSError:
+                        pass
+                elif e.errno in (errno.EAGAIN, errno.EWOULDBLOCK, errno.ENOENT):
+                    # A full buffer means the receiver has notifications waiting anyway,
+                    # and a missing socket means that the receiver just went away.
+                    pass
+                else:
+                    log.warning(u"Unable to notify %s: %s", path, e)
+    finally:
+        sock.close()
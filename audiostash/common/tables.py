@@ -1,10 +1,11 @@
 # -*- coding: utf-8 -*-
 
-from sqlalchemy import Column, String, Integer, ForeignKey, DateTime, Text, Boolean
+from sqlalchemy import Column, String, Integer, ForeignKey, DateTime, Text, Boolean, Index
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
 from sqlalchemy.orm import sessionmaker
-from audiostash.common.utils import utc_now
+from audiostash.common.utils import utc_now, chunked
+from audiostash.common import notify
 
 Base = declarative_base()
 
@@ -14,18 +15,25 @@ USERLEVELS = {
     'admin': 2,
 }
 
+# Tables that clients keep a copy of
+SYNC_TABLES = ('artist', 'album', 'track', 'setting', 'playlist', 'playlistitem')
+
 
 class SyncMixin(object):
     deleted = Column(Boolean, default=False)
-    updated = Column(DateTime(timezone=True), default=utc_now(), onupdate=utc_now())
+    updated = Column(DateTime(timezone=True), default=utc_now, onupdate=utc_now, index=True)
+
+    def serialize_flat(self):
+        """ Serializes the row's own columns only. Other rows are referred to by their ids. """
+        return self.serialize()
 
 
 class Artist(Base, SyncMixin):
     __tablename__ = "artist"
     id = Column(Integer, primary_key=True)
-    name = Column(String(128))
+    name = Column(String(128), index=True)
 
-    def serialize(self):
+    def serialize(self, related=None):
         return {
             'id': self.id,
             'deleted': self.deleted,
@@ -36,9 +44,9 @@ class Artist(Base, SyncMixin):
 class Cover(Base, SyncMixin):
     __tablename__ = "cover"
     id = Column(Integer, primary_key=True)
-    file = Column(String(255))
+    file = Column(String(255), index=True)
 
-    def serialize(self):
+    def serialize(self, related=None):
         return {
             'id': self.id,
             'deleted': self.deleted,
@@ -48,19 +56,31 @@ class Cover(Base, SyncMixin):
 
 class Album(Base, SyncMixin):
     __tablename__ = "album"
+    __table_args__ = (Index('ix_album_title_artist', 'title', 'artist'),)
     id = Column(Integer, primary_key=True)
     title = Column(String(100), nullable=True)
     artist = Column(ForeignKey('artist.id'))
     cover = Column(ForeignKey('cover.id'))
     is_audiobook = Column(Boolean, default=False)
 
-    def serialize(self):
+    def serialize(self, related=None):
+        related = related or Related.load([self])
+        return {
+            'id': self.id,
+            'deleted': self.deleted,
+            'title': self.title,
+            'is_audiobook': 1 if self.is_audiobook else 0,
+            'artist': _serialize_ref(related.artists, self.artist, related),
+            'cover': self.cover
+        }
+
+    def serialize_flat(self):
         return {
             'id': self.id,
             'deleted': self.deleted,
             'title': self.title,
             'is_audiobook': 1 if self.is_audiobook else 0,
-            'artist': session_get().query(Artist).filter_by(id=self.artist, deleted=False).one().serialize(),
+            'artist_id': self.artist,
             'cover': self.cover
         }
 
@@ -68,9 +88,9 @@ class Album(Base, SyncMixin):
 class Directory(Base, SyncMixin):
     __tablename__ = "directory"
     id = Column(Integer, primary_key=True)
-    directory = Column(String(255), nullable=True)
+    directory = Column(String(255), nullable=True, index=True)
 
-    def serialize(self):
+    def serialize(self, related=None):
         return {
             'id': self.id,
             'deleted': self.deleted,
@@ -83,7 +103,7 @@ class Playlist(Base, SyncMixin):
     id = Column(Integer, primary_key=True)
     name = Column(String(64))
 
-    def serialize(self):
+    def serialize(self, related=None):
         return {
             'id': self.id,
             'deleted': self.deleted,
@@ -95,15 +115,25 @@ class PlaylistItem(Base, SyncMixin):
     __tablename__ = "playlistitem"
     id = Column(Integer, primary_key=True)
     track = Column(ForeignKey('track.id'))
-    playlist = Column(ForeignKey('playlist.id'))
+    playlist = Column(ForeignKey('playlist.id'), index=True)
     number = Column(Integer)
 
-    def serialize(self):
+    def serialize(self, related=None):
+        related = related or Related.load([self])
+        return {
+            'id': self.id,
+            'deleted': self.deleted,
+            'playlist': self.playlist,
+            'track': _serialize_ref(related.tracks, self.track, related),
+            'track_id': self.track,
+            'number': self.number
+        }
+
+    def serialize_flat(self):
         return {
             'id': self.id,
             'deleted': self.deleted,
             'playlist': self.playlist,
-            'track': session_get().query(Track).filter_by(id=self.track, deleted=False).one().serialize(),
             'track_id': self.track,
             'number': self.number
         }
@@ -112,13 +142,14 @@ class PlaylistItem(Base, SyncMixin):
 class Track(Base, SyncMixin):
     __tablename__ = "track"
     id = Column(Integer, primary_key=True)
-    file = Column(String(255))
+    file = Column(String(255), index=True, unique=True)
     type = Column(String(8))
     bytes_len = Column(Integer)
     bytes_tc_len = Column(Integer)
-    album = Column(ForeignKey('album.id'))
+    fingerprint = Column(String(64))
+    album = Column(ForeignKey('album.id'), index=True)
     dir = Column(ForeignKey('directory.id'))
-    artist = Column(ForeignKey('artist.id'))
+    artist = Column(ForeignKey('artist.id'), index=True)
     title = Column(String(128))
     track = Column(Integer)
     disc = Column(Integer)
@@ -126,14 +157,30 @@ class Track(Base, SyncMixin):
     genre = Column(String(32))
     comment = Column(Text)
 
-    def serialize(self):
+    def serialize(self, related=None):
+        related = related or Related.load([self])
+        return {
+            'id': self.id,
+            'deleted': self.deleted,
+            'album': _serialize_ref(related.albums, self.album, related),
+            'album_id': self.album,
+            'dir': self.dir,
+            'artist': _serialize_ref(related.artists, self.artist, related),
+            'artist_id': self.artist,
+            'title': self.title,
+            'track': self.track,
+            'disc': self.disc,
+            'date': self.date,
+            'genre': self.genre,
+            'comment': self.comment
+        }
+
+    def serialize_flat(self):
         return {
             'id': self.id,
             'deleted': self.deleted,
-            'album': session_get().query(Album).filter_by(id=self.album, deleted=False).one().serialize(),
             'album_id': self.album,
             'dir': self.dir,
-            'artist': session_get().query(Artist).filter_by(id=self.artist, deleted=False).one().serialize(),
             'artist_id': self.artist,
             'title': self.title,
             'track': self.track,
@@ -144,13 +191,23 @@ class Track(Base, SyncMixin):
         }
 
 
+class TranscodeJob(Base):
+    __tablename__ = "transcodejob"
+    id = Column(Integer, primary_key=True)
+    track = Column(ForeignKey('track.id'), unique=True)
+    priority = Column(Integer, default=0)
+    attempts = Column(Integer, default=0)
+    running = Column(Boolean, default=False)
+    error = Column(Text)
+
+
 class Setting(Base, SyncMixin):
     __tablename__ = "setting"
     id = Column(Integer, primary_key=True)
     key = Column(String(32))
     value = Column(Text)
 
-    def serialize(self):
+    def serialize(self, related=None):
         return {
             'id': self.id,
             'deleted': self.deleted,
@@ -164,7 +221,7 @@ class Log(Base, SyncMixin):
     id = Column(Integer, primary_key=True)
     entry = Column(Text)
 
-    def serialize(self):
+    def serialize(self, related=None):
         return {
             'id': self.id,
             'deleted': self.deleted,
@@ -187,9 +244,81 @@ class Session(Base):
     start = Column(DateTime(timezone=True), default=utc_now())
 
 
+class Revision(Base):
+    """ Change counter for each synced table, and for sessions. Bumped by every transaction that changes the table. """
+    __tablename__ = "revision"
+    name = Column(String(32), primary_key=True)
+    revision = Column(Integer, default=0)
+
+
+def bump_revisions(s, *tables):
+    """ Marks tables as changed. Call in the same transaction as the changes, so that both get committed together. """
+    s.query(Revision).filter(Revision.name.in_(tables))\
+        .update({'revision': Revision.revision + 1}, synchronize_session=False)
+    s.info['revisions_bumped'] = True
+
+
+def _serialize_ref(rows, row_id, related):
+    # Each related row is serialized once, however many rows refer to it
+    key = (id(rows), row_id)
+    if key not in related.serialized:
+        row = rows.get(row_id)
+        related.serialized[key] = row.serialize(related) if row else None
+    return related.serialized[key]
+
+
+def _rows_by_id(s, table, ids):
+    rows = {}
+    for chunk in chunked(ids):
+        for row in s.query(table).filter(table.id.in_(chunk)):
+            rows[row.id] = row
+    return rows
+
+
+class Related(object):
+    """
+    Rows referred to by a set of rows being serialized, mapped by id. These are loaded in bulk,
+    with a few queries per related table instead of a few queries per serialized row.
+    """
+    def __init__(self, s, rows):
+        self.tracks = _rows_by_id(s, Track, set(r.track for r in rows if isinstance(r, PlaylistItem)))
+        tracks = [r for r in rows if isinstance(r, Track)] + self.tracks.values()
+        self.albums = _rows_by_id(s, Album, set(t.album for t in tracks))
+        albums = [r for r in rows if isinstance(r, Album)] + self.albums.values()
+        self.artists = _rows_by_id(s, Artist, set(t.artist for t in tracks) | set(a.artist for a in albums))
+        self.serialized = {}
+
+    @classmethod
+    def load(cls, rows):
+        s = session_get()
+        related = cls(s, rows)
+        s.close()
+        return related
+
+
+def serialize_rows(s, rows, flat=False):
+    """ Serializes a list of rows, loading everything they refer to in bulk. Flat rows need nothing loaded. """
+    if flat:
+        return [row.serialize_flat() for row in rows]
+    related = Related(s, rows)
+    return [row.serialize(related) for row in rows]
+
+
 _session = sessionmaker()
 
 
+@event.listens_for(_session, 'after_commit')
+def _notify_revisions(s):
+    # Other processes (eg. scand -> webui) learn about committed changes right away
+    if s.info.pop('revisions_bumped', False):
+        notify.publish()
+
+
+@event.listens_for(_session, 'after_rollback')
+def _forget_revisions(s):
+    s.info.pop('revisions_bumped', None)
+
+
 def database_init(engine_str):
     _engine = create_engine(engine_str, pool_recycle=3600)
     _session.configure(bind=_engine)
@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+
+import os
+import logging
+
+from audiostash import settings
+from PIL import Image
+
+log = logging.getLogger(__name__)
+
+# Thumbnail names and their maximum dimensions, largest first
+SIZES = (('medium', 800), ('small', 200))
+
+
+def thumbnail_path(cover_id, name, fmt='jpg'):
+    """ Path of a cover thumbnail """
+    return os.path.join(settings.COVER_CACHE_DIRECTORY, "{}_{}.{}".format(cover_id, name, fmt))
+
+
+def _formats():
+    return ('jpg', 'webp') if settings.COVER_WEBP else ('jpg',)
+
+
+def _up_to_date(cover_id, source_mtime):
+    for name, dimension in SIZES:
+        for fmt in _formats():
+            try:
+                if os.stat(thumbnail_path(cover_id, name, fmt)).st_mtime < source_mtime:
+                    return False
+            except OSError:
+                return False
+    return True
+
+
+def make_thumbnails(job):
+    """
+    Creates all thumbnails for a cover from a single decode of the source image. Thumbnails that are
+    newer than the source are left alone. Takes and returns plain tuples, so that this can be run
+    in a worker process. Returns (cover id, error message or None).
+    """
+    cover_id, source = job
+    try:
+        if _up_to_date(cover_id, os.stat(source).st_mtime):
+            return cover_id, None
+
+        img = Image.open(source)
+
+        # Let the JPEG decoder scale down while decoding; much faster than decoding everything
+        largest = SIZES[0][1]
+        img.draft('RGB', (largest, largest))
+        if img.mode not in ('RGB', 'L'):
+            img = img.convert('RGB')
+
+        # Each size is scaled down from the previous one
+        for name, dimension in SIZES:
+            img.thumbnail((dimension, dimension), Image.ANTIALIAS)
+            img.save(thumbnail_path(cover_id, name), "JPEG", optimize=True)
+            if settings.COVER_WEBP:
+                img.save(thumbnail_path(cover_id, name, 'webp'), "WEBP", quality=80)
+    except (IOError, OSError, ValueError, KeyError) as e:
+        return cover_id, unicode(e)
+    return cover_id, None
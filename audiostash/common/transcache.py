@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import logging
+
+from audiostash import settings
+from audiostash.common.tables import session_get, Track, TranscodeJob
+from audiostash.common.utils import chunked
+
+log = logging.getLogger(__name__)
+
+# Priority for transcodes that a listener is waiting for
+PLAY_PRIORITY = 10
+
+
+def cache_file_path(track_id):
+    """ Path of the transcoded version of a track """
+    return os.path.join(settings.MUSIC_CACHE_DIRECTORY, "{}.{}".format(track_id, settings.TRANSCODE_FORMAT))
+
+
+def enqueue_transcodes(track_ids, priority=0):
+    """ Adds transcode jobs for the given tracks. Existing jobs for the tracks are reset and reprioritized. """
+    track_ids = set(track_ids)
+    if not track_ids:
+        return
+    s = session_get()
+    existing = set()
+    for chunk in chunked(track_ids):
+        existing.update(t for t, in s.query(TranscodeJob.track).filter(TranscodeJob.track.in_(chunk)))
+        s.query(TranscodeJob).filter(TranscodeJob.track.in_(chunk))\
+            .update({'priority': priority, 'attempts': 0, 'error': None}, synchronize_session=False)
+    s.bulk_insert_mappings(TranscodeJob, [
+        {'track': t, 'priority': priority, 'attempts': 0, 'running': False}
+        for t in track_ids if t not in existing])
+    s.commit()
+    s.close()
+
+
+def touch(track_id):
+    """ Marks the transcoded file as recently played. Least recently played files get evicted first. """
+    try:
+        os.utime(cache_file_path(track_id), None)
+    except OSError:
+        pass
+
+
+class TranscodeCache(object):
+    """
+    Keeps the transcode cache directory within a byte budget. When the budget is exceeded, the least recently
+    played transcodes are removed until the cache is below the low watermark, and their tracks are marked as
+    not transcoded. Playing time is the modification time of the file, see touch().
+    """
+    def __init__(self, max_bytes, low_watermark=0.9, check_interval=60):
+        self.max_bytes = max_bytes
+        self.low_watermark = low_watermark
+        self.check_interval = check_interval
+        self._last_check = 0
+
+    def maybe_enforce(self):
+        """ Like enforce, but lists the cache directory at most once per check interval """
+        if time.time() - self._last_check < self.check_interval:
+            return 0
+        return self.enforce()
+
+    def enforce(self):
+        """ Evicts files if needed. Returns the number of evicted files. """
+        if not self.max_bytes:
+            return 0
+
+        self._last_check = time.time()
+        total = 0
+        files = []
+        suffix = '.' + settings.TRANSCODE_FORMAT
+        for name in os.listdir(settings.MUSIC_CACHE_DIRECTORY):
+            try:
+                st = os.stat(os.path.join(settings.MUSIC_CACHE_DIRECTORY, name))
+            except OSError:
+                continue
+            total += st.st_size
+
+            # Only finished transcodes can be evicted
+            track_id, ext = os.path.splitext(name)
+            if ext == suffix and track_id.isdigit():
+                files.append((st.st_mtime, st.st_size, int(track_id)))
+
+        if total <= self.max_bytes:
+            return 0
+
+        target = self.max_bytes * self.low_watermark
+        evicted = []
+        for mtime, size, track_id in sorted(files):
+            if total <= target:
+                break
+            try:
+                os.remove(cache_file_path(track_id))
+            except OSError:
+                continue
+            total -= size
+            evicted.append(track_id)
+
+        s = session_get()
+        for chunk in chunked(evicted):
+            s.query(Track).filter(Track.id.in_(chunk)).update({
+                'bytes_tc_len': 0,
+                'updated': Track.updated  # Not interesting for clients; don't trigger a sync
+            }, synchronize_session=False)
+        s.commit()
+        s.close()
+
+        log.info(u"Evicted %d files from the transcode cache, %d bytes left.", len(evicted), total)
+        return len(evicted)
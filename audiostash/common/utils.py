@@ -24,8 +24,9 @@ def utc_minus_delta(seconds):
 
 
 def to_isodate(dt):
-    """ Converts datetime to iso8601-timestamp """
-    return isodate.datetime_isoformat(dt)
+    """ Converts datetime to iso8601-timestamp, keeping the fractions of a second """
+    return isodate.datetime_isoformat(dt, isodate.DATE_EXT_COMPLETE + 'T' + isodate.TIME_EXT_COMPLETE + '.%f' +
+                                      isodate.TZ_EXT)
 
 
 def from_isodate(ts):
@@ -38,6 +39,11 @@ def decode_path(name):
     return name.decode(sys.getfilesystemencoding())
 
 
+def file_fingerprint(st):
+    """ Makes a change detection fingerprint out of a stat result """
+    return u"{}:{}:{}".format(st.st_size, int(st.st_mtime), st.st_ino)
+
+
 def match_track_filename(filename):
     """ Attempt to detect title and artist from song filename """
     m = track_matcher_1.match(filename)
@@ -56,17 +62,24 @@ def match_track_filename(filename):
 
 
 def get_or_create(session, model, **kwargs):
-    """ Gets an instance if it exists, or creates a new one if not. """
+    """ Gets an instance if it exists, or creates a new one if not. New instances are flushed, not committed. """
     instance = session.query(model).filter_by(**kwargs).first()
     if instance:
         return instance
     else:
         instance = model(**kwargs)
         session.add(instance)
-        session.commit()
+        session.flush()
         return instance
 
 
+def chunked(items, size=500):
+    """ Splits items into lists of at most size items. Keeps IN-lists below the SQLite parameter limit. """
+    items = list(items)
+    for i in range(0, len(items), size):
+        yield items[i:i+size]
+
+
 def generate_session():
     """ Generates a session ID. Secure enough. """
     return binascii.hexlify(os.urandom(16))
@@ -41,11 +41,18 @@ app.config(function ($indexedDBProvider) {
             track_store.createIndex("is_audiobook", "album.is_audiobook", {unique: false});
             settings_store.createIndex("key", "key", {unique: true});
             artist_store.createIndex("id","id", {unique: false});
+        })
+        .upgradeDatabase(2, function (event, db, tx) {
+            // Rows are now synced with the ids of the rows they refer to, and joined when read (see DataService).
+            // The old rows have the related rows embedded, so throw them away. DataService syncs everything again.
+            var stores = ["artist", "album", "playlist", "playlistitem", "track", "setting"];
+            for (var i = 0; i < stores.length; i++) {
+                tx.objectStore(stores[i]).clear();
+            }
+            tx.objectStore("album").deleteIndex("artist");
+            tx.objectStore("album").createIndex("artist_id", "artist_id", {unique: false});
+            tx.objectStore("track").deleteIndex("is_audiobook");
         });
-        /*.upgradeDatabase(2, function (event, db, tx) {
-            var track_store = event.currentTarget.transaction.objectStore("track");
-
-        });*/
 });
 
 // Sockjs
@@ -55,13 +55,13 @@ app.run(['$rootScope', '$location', 'AuthService', 'DataService', 'SockService',
     }
 ]);
 
-app.controller('AlbumsController', ['$scope', '$rootScope', '$indexedDB', '$location', 'SYNC_EVENTS',
-    function ($scope, $rootScope, $indexedDB, $location, SYNC_EVENTS) {
+app.controller('AlbumsController', ['$scope', '$rootScope', '$indexedDB', '$location', 'SYNC_EVENTS', 'DataService',
+    function ($scope, $rootScope, $indexedDB, $location, SYNC_EVENTS, DataService) {
         $scope.albums = [];
 
         function refresh() {
             $indexedDB.openStore('album', function (store) {
-                store.eachWhere(store.query().$index('is_audiobook').$eq(0)).then(function (albums) {
+                store.eachWhere(store.query().$index('is_audiobook').$eq(0)).then(DataService.join_albums).then(function (albums) {
                     $scope.albums = albums;
                 });
             });
@@ -91,13 +91,13 @@ app.controller('SettingsController', ['$scope', '$rootScope', 'SYNC_EVENTS', 'Da
     }
 ]);
 
-app.controller('AudiobooksController', ['$scope', '$rootScope', '$indexedDB', '$location', 'SYNC_EVENTS',
-    function ($scope, $rootScope, $indexedDB, $location, SYNC_EVENTS) {
+app.controller('AudiobooksController', ['$scope', '$rootScope', '$indexedDB', '$location', 'SYNC_EVENTS', 'DataService',
+    function ($scope, $rootScope, $indexedDB, $location, SYNC_EVENTS, DataService) {
         $scope.albums = [];
 
         function refresh() {
             $indexedDB.openStore('album', function (store) {
-                store.eachWhere(store.query().$index('is_audiobook').$eq(1)).then(function (albums) {
+                store.eachWhere(store.query().$index('is_audiobook').$eq(1)).then(DataService.join_albums).then(function (albums) {
                     $scope.albums = albums;
                 });
             });
@@ -147,8 +147,8 @@ app.controller('PlayerController', ['$scope', 'AuthService', 'PlaylistService',
     }
 ]);
 
-app.controller('PlaylistEditController', ['$scope', '$indexedDB', '$location', '$routeParams', 'PlaylistService',
-    function ($scope, $indexedDB, $location, $routeParams, PlaylistService) {
+app.controller('PlaylistEditController', ['$scope', '$indexedDB', '$location', '$routeParams', 'PlaylistService', 'DataService',
+    function ($scope, $indexedDB, $location, $routeParams, PlaylistService, DataService) {
         $scope.playlist = null;
         $scope.grid_opts = {
             enableFiltering: false,
@@ -196,7 +196,7 @@ app.controller('PlaylistEditController', ['$scope', '$indexedDB', '$location', '
                 });
             });
             $indexedDB.openStore('playlistitem', function (store) {
-                store.eachWhere(store.query().$index('playlist').$eq(playlist_id)).then(function (tracks) {
+                store.eachWhere(store.query().$index('playlist').$eq(playlist_id)).then(DataService.join_playlistitems).then(function (tracks) {
                     tracks.sort(function(a,b) {
                         return a.number - b.number;
                     });
@@ -376,8 +376,8 @@ app.controller('saveScratchpadController', ['$scope', '$modalInstance', '$indexe
     }
 ]);
 
-app.controller('AlbumTrackController', ['$scope', '$indexedDB', '$location', '$routeParams', 'PlaylistService',
-    function ($scope, $indexedDB, $location, $routeParams, PlaylistService) {
+app.controller('AlbumTrackController', ['$scope', '$indexedDB', '$location', '$routeParams', 'PlaylistService', 'DataService',
+    function ($scope, $indexedDB, $location, $routeParams, PlaylistService, DataService) {
         $scope.$scope = $scope;
         $scope.artist = null;
         $scope.album = null;
@@ -428,12 +428,12 @@ app.controller('AlbumTrackController', ['$scope', '$indexedDB', '$location', '$r
                 var match = false;
                 [
                     row.entity.title,
-                    row.entity.artist.name,
-                    row.entity.album.title,
+                    row.entity.artist ? row.entity.artist.name : '',
+                    row.entity.album ? row.entity.album.title : '',
                     row.entity.date,
                     row.entity.genre
                 ].forEach(function (field) {
-                    if (field.toLowerCase().match(matcher)) {
+                    if (field != null && String(field).toLowerCase().match(matcher)) {
                         match = true;
                     }
                 });
@@ -446,7 +446,10 @@ app.controller('AlbumTrackController', ['$scope', '$indexedDB', '$location', '$r
 
         function refresh() {
             $indexedDB.openStore('track', function (store) {
-                store.eachWhere(store.query().$index('is_audiobook').$eq(0)).then(function (tracks) {
+                store.getAll().then(DataService.join_tracks).then(function (tracks) {
+                    tracks = tracks.filter(function (track) {
+                        return track.album == null || track.album.is_audiobook == 0;
+                    });
                     $scope.grid_opts.minRowsToShow = tracks.length;
                     $scope.grid_opts.virtualizationThreshold = tracks.length;
                     $scope.grid_opts.data = tracks;
@@ -1,11 +1,14 @@
 'use strict';
 
-app.factory('DataService', ['$indexedDB', '$rootScope', '$timeout', 'SockService', 'SYNC_EVENTS',
-    function ($indexedDB, $rootScope, $timeout, SockService, SYNC_EVENTS) {
+app.factory('DataService', ['$indexedDB', '$rootScope', '$timeout', '$q', 'SockService', 'SYNC_EVENTS',
+    function ($indexedDB, $rootScope, $timeout, $q, SockService, SYNC_EVENTS) {
         var svc = null;
         var sync_list = [];
         var stopped = false;
+        var syncing = false;
         var update_timeout = 25000;
+        var sync_page_size = 1000;
+        var sync_version = 2;  // Rows come with ids of the rows they refer to; see the join functions below.
         var sync_tables = [
             'artist',
             'album',
@@ -18,6 +21,25 @@ app.factory('DataService', ['$indexedDB', '$rootScope', '$timeout', 'SockService
         function sync_check_start() {
             sync_list = sync_tables.slice();
             console.log("Sync starting.");
+            syncing = true;
+            $rootScope.$broadcast(SYNC_EVENTS.started);
+            sync_data_fetch();
+        }
+
+        function sync_tables_changed(tables) {
+            // Server tells us which tables have changed; queue them up for syncing.
+            for (var table in tables) {
+                if (sync_tables.indexOf(table) != -1 && sync_list.indexOf(table) == -1) {
+                    sync_list.push(table);
+                }
+            }
+
+            // If a sync is already running, it will pick up the queued tables.
+            if (syncing || sync_list.length == 0) {
+                return;
+            }
+            console.log("Tables changed, sync starting.");
+            syncing = true;
             $rootScope.$broadcast(SYNC_EVENTS.started);
             sync_data_fetch();
         }
@@ -25,7 +47,7 @@ app.factory('DataService', ['$indexedDB', '$rootScope', '$timeout', 'SockService
         function sync_data_fetch() {
             // If there is nothing more to sync, stop here.
             if (sync_list.length == 0) {
-                schedule_next_sync();
+                syncing = false;
                 console.log("Sync finished.");
                 $rootScope.$broadcast(SYNC_EVENTS.stopped);
                 return;
@@ -34,22 +56,73 @@ app.factory('DataService', ['$indexedDB', '$rootScope', '$timeout', 'SockService
             // Request for data for all tables
             var table_name = sync_list.shift();
             console.log("sync_data_fetch for '" + table_name + "'.");
+            sync_page_fetch(table_name, localStorage[table_name], localStorage[table_name + '_id'] || 0);
+        }
+
+        function sync_page_fetch(table_name, ts, id) {
             SockService.send({
                 'type': 'sync',
                 'message': {
                     'query': 'request',
-                    'ts': localStorage[table_name],
+                    'ts': ts,
+                    'id': id,
+                    'limit': sync_page_size,
+                    'format': 'columns',
+                    'version': sync_version,
                     'table': table_name
                 }
             });
         }
 
+        function save_cursor(msg) {
+            // Pushes only cover recent changes, and don't move the cursor of a regular sync.
+            if(msg['push']) {
+                return;
+            }
+            localStorage[msg['table']] = msg['ts'];
+            localStorage[msg['table'] + '_id'] = msg['id'];
+        }
+
+        function decode_rows(block, lookup) {
+            var names = Object.keys(block['columns']);
+            var rows = [];
+            for (var i = 0; i < block['count']; i++) {
+                var row = {};
+                for (var k = 0; k < names.length; k++) {
+                    var value = block['columns'][names[k]][i];
+                    if (value != null && block['refs'].indexOf(names[k]) != -1) {
+                        value = lookup(names[k], value);
+                    }
+                    row[names[k]] = value;
+                }
+                rows.push(row);
+            }
+            return rows;
+        }
+
+        function decode_columns(block) {
+            // Columnar sync data has the rows embedded in other rows (eg. album of a track) only once,
+            // and refers to them by id. Put them back in place, so that the stored rows look the same.
+            var related = {};
+            function lookup(name, id) {
+                if (!(name in related)) {
+                    related[name] = {};
+                    var rows = decode_rows(block['related'][name], lookup);
+                    for (var i = 0; i < rows.length; i++) {
+                        related[name][rows[i]['id']] = rows[i];
+                    }
+                }
+                return related[name][id] || null;
+            }
+            return decode_rows(block, lookup);
+        }
+
         function sync_request_response(msg) {
-            var data = msg['data'];
+            var data = msg['format'] == 'columns' ? decode_columns(msg['data']) : msg['data'];
             var table = msg['table'];
-            localStorage[table] = msg['ts'];
 
-            // Insert if we have something new
+            // Insert if we have something new. The cursor is only moved after the page is stored,
+            // so that an interrupted sync continues from the last stored page.
             if(data.length > 0) {
                 console.log("Received "+data.length+" new entries.");
                 $indexedDB.openStore(table, function (store) {
@@ -60,8 +133,11 @@ app.factory('DataService', ['$indexedDB', '$rootScope', '$timeout', 'SockService
                             store.upsert(data[i]);
                         }
                     }
+                    save_cursor(msg);
                     $rootScope.$broadcast(SYNC_EVENTS.newData);
                 });
+            } else {
+                save_cursor(msg);
             }
 
             // If this is a push message, stop execution after handling the response
@@ -72,8 +148,12 @@ app.factory('DataService', ['$indexedDB', '$rootScope', '$timeout', 'SockService
                 }
             }
 
-            // ... Otherwise just continue with the data query
-            sync_data_fetch();
+            // ... Otherwise fetch the next page of this table, or continue with the next table
+            if(msg['more']) {
+                sync_page_fetch(table, msg['ts'], msg['id']);
+            } else {
+                sync_data_fetch();
+            }
         }
 
         function sync_event(msg) {
@@ -85,24 +165,92 @@ app.factory('DataService', ['$indexedDB', '$rootScope', '$timeout', 'SockService
             // ... Otherwise handle the message
             if (msg['error'] == 1) {
                 console.error("Error while syncing: '" + msg['data']['message'] + "'. Scheduling new sync.");
+                syncing = false;
                 schedule_next_sync();
             } else {
                 var data = msg['data'];
                 if (data['query'] == 'request') {
                     sync_request_response(data);
+                } else if (data['query'] == 'changed') {
+                    sync_tables_changed(data['tables']);
                 }
             }
         }
 
         function reset_localstorage() {
-            if (localStorage.getItem("initialized") == null) {
+            // Rows synced with another protocol version are thrown away when the database is upgraded,
+            // so start from the beginning.
+            if (localStorage.getItem("initialized") == null || localStorage['sync_version'] != sync_version) {
                 for (var i = 0; i < sync_tables.length; i++) {
                     localStorage[sync_tables[i]] = "2000-01-01T00:00:00Z";
+                    localStorage[sync_tables[i] + '_id'] = 0;
                 }
                 localStorage['initialized'] = 1;
+                localStorage['sync_version'] = sync_version;
             }
         }
 
+        function load_by_id(table) {
+            var deferred = $q.defer();
+            $indexedDB.openStore(table, function (store) {
+                store.getAll().then(function (rows) {
+                    var by_id = {};
+                    for (var i = 0; i < rows.length; i++) {
+                        by_id[rows[i]['id']] = rows[i];
+                    }
+                    deferred.resolve(by_id);
+                });
+            });
+            return deferred.promise;
+        }
+
+        // Synced rows only have the ids of the rows they refer to. These fill in the related rows
+        // (eg. track.album and track.artist), and return a promise for the given rows.
+        function join_albums(albums) {
+            return load_by_id('artist').then(function (artists) {
+                for (var i = 0; i < albums.length; i++) {
+                    albums[i].artist = artists[albums[i].artist_id] || null;
+                }
+                return albums;
+            });
+        }
+
+        function join_tracks(tracks) {
+            return $q.all([load_by_id('artist'), load_by_id('album')]).then(function (found) {
+                var artists = found[0];
+                var albums = found[1];
+                for (var i = 0; i < tracks.length; i++) {
+                    var album = albums[tracks[i].album_id] || null;
+                    if (album != null) {
+                        album.artist = artists[album.artist_id] || null;
+                    }
+                    tracks[i].album = album;
+                    tracks[i].artist = artists[tracks[i].artist_id] || null;
+                }
+                return tracks;
+            });
+        }
+
+        function join_playlistitems(items) {
+            var deferred = $q.defer();
+            $indexedDB.openStore('track', function (store) {
+                var finds = [];
+                for (var i = 0; i < items.length; i++) {
+                    // Missing tracks are null, like they are in the server's answers
+                    finds.push(store.find(items[i].track_id).then(null, function () { return null; }));
+                }
+                $q.all(finds).then(function (tracks) {
+                    join_tracks(tracks.filter(function (track) { return track != null; })).then(function () {
+                        for (var i = 0; i < items.length; i++) {
+                            items[i].track = tracks[i];
+                        }
+                        deferred.resolve(items);
+                    });
+                });
+            });
+            return deferred.promise;
+        }
+
         function clear_localstorage() {
             localStorage.clear();
         }
@@ -132,6 +280,7 @@ app.factory('DataService', ['$indexedDB', '$rootScope', '$timeout', 'SockService
 
         function sync_stop() {
             stopped = true;
+            syncing = false;
             sync_list = [];
             if (svc != null) {
                 $timeout.cancel(svc);
@@ -148,7 +297,10 @@ app.factory('DataService', ['$indexedDB', '$rootScope', '$timeout', 'SockService
             start: sync_init,
             stop: sync_stop,
             clear_database: clear_database,
-            clear_localstorage: clear_localstorage
+            clear_localstorage: clear_localstorage,
+            join_albums: join_albums,
+            join_tracks: join_tracks,
+            join_playlistitems: join_playlistitems
         }
     }
 ]);
\ No newline at end of file
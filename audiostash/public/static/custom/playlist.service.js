@@ -1,23 +1,27 @@
 'use strict';
 
-app.factory('PlaylistService', ['$rootScope', '$indexedDB', 'SockService', 'PLAYLIST_EVENTS',
-    function ($rootScope, $indexedDB, SockService, PLAYLIST_EVENTS) {
+app.factory('PlaylistService', ['$rootScope', '$indexedDB', 'SockService', 'DataService', 'PLAYLIST_EVENTS',
+    function ($rootScope, $indexedDB, SockService, DataService, PLAYLIST_EVENTS) {
         var playlist = [];
 
         function add(track_id) {
             $indexedDB.openStore('track', function (store) {
                 store.find(track_id).then(function (track) {
-                    add_track(track);
+                    DataService.join_tracks([track]).then(function () {
+                        add_track(track);
+                    });
                 });
             });
         }
 
         function add_tracks(tracks) {
-            for (var i = 0; i < tracks.length; i++) {
-                _add_track(tracks[i]);
-            }
-            save();
-            $rootScope.$broadcast(PLAYLIST_EVENTS.refresh);
+            DataService.join_tracks(tracks).then(function () {
+                for (var i = 0; i < tracks.length; i++) {
+                    _add_track(tracks[i]);
+                }
+                save();
+                $rootScope.$broadcast(PLAYLIST_EVENTS.refresh);
+            });
         }
 
         function add_track(track) {
@@ -84,7 +88,7 @@ app.factory('PlaylistService', ['$rootScope', '$indexedDB', 'SockService', 'PLAY
         function load_playlist(id) {
             playlist = [];
             $indexedDB.openStore('playlistitem', function (store) {
-                store.eachWhere(store.query().$index('playlist').$eq(id)).then(function(entries) {
+                store.eachWhere(store.query().$index('playlist').$eq(id)).then(DataService.join_playlistitems).then(function(entries) {
                     entries.sort(function(a, b) {
                         return a.number - b.number;
                     });
@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+
+import logging
+
+from audiostash.common.cache import LRUCache
+from audiostash.common.tables import session_get, Album, Directory, Artist
+
+log = logging.getLogger(__name__)
+
+
+class IdentityCache(object):
+    """
+    Remembers the ids of non-deleted artists (by name), albums (by title and artist id)
+    and directories (by path), so that the scanner only has to query for rows it has not seen yet.
+    """
+    def __init__(self, capacity):
+        self.artists = LRUCache(capacity)
+        self.albums = LRUCache(capacity)
+        self.directories = LRUCache(capacity)
+
+    def preload(self):
+        """ Fills the caches with existing rows. Meant to be run at the start of a scan. """
+        s = session_get()
+        for artist_id, name in s.query(Artist.id, Artist.name)\
+                .filter_by(deleted=False).limit(self.artists.capacity):
+            self.artists.put(name, artist_id)
+        for album_id, title, artist_id in s.query(Album.id, Album.title, Album.artist)\
+                .filter_by(deleted=False).limit(self.albums.capacity):
+            self.albums.put((title, artist_id), album_id)
+        for dir_id, directory in s.query(Directory.id, Directory.directory)\
+                .filter_by(deleted=False).limit(self.directories.capacity):
+            self.directories.put(directory, dir_id)
+        s.close()
+        log.debug(u"Identity cache has %d artists, %d albums and %d directories.",
+                  len(self.artists), len(self.albums), len(self.directories))
+
+    def forget_artist(self, name):
+        self.artists.pop(name)
+
+    def forget_album(self, title, artist_id):
+        self.albums.pop((title, artist_id))
+
+    def forget_directory(self, directory):
+        self.directories.pop(directory)
+
+    def clear(self):
+        self.artists.clear()
+        self.albums.clear()
+        self.directories.clear()
@@ -1,267 +1,185 @@
 # -*- coding: utf-8 -*-
 
 import os
-import mutagen
+import stat
+import time
 import logging
+import multiprocessing
 
-from audiostash.common import audiotranscode
 from audiostash.common.tables import \
-    database_ensure_initial, session_get, \
+    database_ensure_initial, session_get, bump_revisions, \
     Track, Album, Directory, Artist, Cover, Playlist
-from audiostash.common.utils import decode_path, match_track_filename, get_or_create, utc_now
+from audiostash.common.utils import decode_path, get_or_create, utc_now, file_fingerprint, chunked
+from audiostash.scand.tags import read_tags, init_worker
+from audiostash.scand.writer import TrackWriter
+from audiostash.scand.identity import IdentityCache
+from audiostash.scand.watcher import Watcher
+from audiostash.scand.transcoder import TranscodeQueue
+from audiostash.common.transcache import enqueue_transcodes
+from audiostash.common.thumbnails import make_thumbnails
 from audiostash import settings
 from twisted.internet import reactor, task
+from sqlalchemy import func, distinct, select, exists, and_
 from sqlalchemy.orm.exc import NoResultFound
-from PIL import Image
+
+try:
+    from os import scandir
+except ImportError:
+    from scandir import scandir
 
 log = logging.getLogger(__name__)
 
+# Files handed to the tag reader pool per worker at a time, and the chunk size of a single pool task.
+TAG_BATCH_SIZE = 64
+TAG_CHUNK_SIZE = 8
+
 
 class Scanner(object):
-    @staticmethod
-    def _get_tag(m, keys):
-        for tag in keys:
-            try:
-                return unicode(m[tag][0])
-            except KeyError:
-                pass
-            except ValueError:
-                pass
-        return u''
+    def load_fingerprints(self):
+        """ Loads the fingerprints of all known tracks, so that unchanged files can be skipped without queries. """
+        s = session_get()
+        self._fingerprints = {}
+        for track_id, path, fingerprint, bytes_len, deleted in \
+                s.query(Track.id, Track.file, Track.fingerprint, Track.bytes_len, Track.deleted):
+            self._fingerprints[path] = (track_id, fingerprint, bytes_len, deleted)
+        s.close()
+        log.debug(u"Loaded fingerprints for %d tracks.", len(self._fingerprints))
 
-    @staticmethod
-    def _get_tag_int(m, keys):
-        for tag in keys:
-            try:
-                return int(m[tag][0])
-            except KeyError:
-                pass
-            except ValueError:
-                pass
-        return None
+    def find_track(self, path):
+        """ Finds (id, fingerprint, bytes_len, deleted) of a known track, or None if the track is new. """
+        if self._fingerprints is not None:
+            return self._fingerprints.get(path)
+        s = session_get()
+        try:
+            return s.query(Track.id, Track.fingerprint, Track.bytes_len, Track.deleted).filter_by(file=path).one()
+        except NoResultFound:
+            return None
+        finally:
+            s.close()
 
-    @staticmethod
-    def _get_tag_tuple(m, keys):
-        for tag in keys:
-            try:
-                return m[tag][0]
-            except KeyError:
-                pass
-            except ValueError:
-                pass
-        return None
-
-    # TODO: Better tag lookup
-    # TODO: Use subsessions for track components (artist, etc)
-    def handle_audio(self, path, ext, is_audiobook):
+    def adopt_fingerprints(self):
+        """ Saves fingerprints for tracks that were scanned before fingerprints existed. """
+        if not self._adopted:
+            return
         s = session_get()
+        s.bulk_update_mappings(Track, [{'id': i, 'fingerprint': f} for i, f in self._adopted])
+        s.commit()
+        s.close()
+        log.debug(u"Saved fingerprints for %d unchanged tracks.", len(self._adopted))
+        self._adopted = []
 
+    def handle_audio(self, path, ext, is_audiobook, st):
         # If track already exists and has not changed, stop here
         # Otherwise either edit or create new track entry
-        fsize = os.path.getsize(path)
-        try:
-            track = s.query(Track).filter_by(file=path).one()
-            if fsize == track.bytes_len:
-                s.close()
+        fingerprint = file_fingerprint(st)
+        track_id = None
+        known = self.find_track(path)
+        if known:
+            track_id, old_fingerprint, bytes_len, deleted = known
+            if fingerprint == old_fingerprint and not deleted:
                 return
-        except NoResultFound:
-            track = Track(file=path, album=1, artist=1, type=ext[1:])
 
-        # Attempt to open up the file in Mutagen for tag information
-        m = None
-        try:
-            m = mutagen.File(path)
-        except:
-            log.warning(u"Could not read header for %s", path)
-
-        # Set correct sizes
-        track.bytes_len = fsize
-        track.bytes_tc_len = 0
-
-        if m:
-            # Find artist
-            track_artist = self._get_tag(m, ('TPE1', u'©ART', 'Author', 'Artist', 'ARTIST', 'TXXX:ARTIST'
-                                             'TRACK ARTIST', 'TRACKARTIST', 'TrackArtist', 'Track Artist',
-                                             'artist'))
-
-            # Find album artist
-            album_artist = self._get_tag(m, ('TPE2', u'aART', 'TXXX:ALBUM ARTIST', 'TXXX:ALBUMARTIST', 'ALBUM ARTIST',
-                                             'ALBUMARTIST', 'AlbumArtist', 'Album Artist'))
-
-            # Find album title
-            album_title = self._get_tag(m, (u'©alb', 'TALB', 'ALBUM', 'album', 'TXXX:ALBUM'))
-            
-            # Find title
-            track_title = self._get_tag(m, (u'©nam', 'TXXX:TITLE', 'TIT2', 'Title', 'TITLE', 'TRACK TITLE',
-                                            'TRACKTITLE', 'TrackTitle', 'Track Title'))
-
-            # Find track number
-            track_tags = ('TRCK', 'TXXX:TRACK', 'Track', 'trkn', 'TRACK', 'tracknumber', 'TRACKNUMBER')
-            track_number = self._get_tag_tuple(m, track_tags)
-            if type(track_number) == tuple:
-                track.track = int(track_number[0])
-            else:
-                track_number = self._get_tag(m, track_tags)
-                if '/' in track_number:
-                    track.track = int(track_number.split('/')[0])
-                elif track_number:
-                    track.track = int(track_number)
-
-            # Find disc number
-            disc_tags = ('TXXX:DISCNUMBER', 'discnumber', 'DISCNUMBER', 'TPOS')
-            track_disc = self._get_tag_tuple(m, disc_tags)
-            if type(track_disc) == tuple:
-                track.disc = int(track_disc[0])
-            else:
-                track_disc = self._get_tag(m, disc_tags)
-                if '/' in track_disc:
-                    track.disc = int(track_disc.split('/')[0])
-                elif track_disc:
-                    track.disc = int(track_disc)
-
-            # Find Genre/Content type
-            track.genre = self._get_tag(m, ('TCON', u'@gen', 'gnre', 'Genre', 'genre', 'GENRE', 'TXXX:GENRE'))
-
-            # Find date
-            track.date = self._get_tag(m, ('TYER', 'TDAT', 'TDRC', 'TDRL', u'@day', 'date', "DATE", "YEAR", "Date",
-                                           "Year", 'TXXX:YEAR'))
-            if track.date is None:
-                track.date = u""
-            
-            # Set track title, if found
-            if track_title:
-                track.title = track_title
-            elif track.track and album_title:
-                track.title = album_title + u" " + str(track.track)
-            elif track.track:
-                track.title = "Track " + str(track.track)
-            else:
-                track.title = os.path.splitext(os.path.basename(path))[0]
-            
-            # If there is a track artist, add it to its own model
-            if track_artist:
-                artist = get_or_create(s, Artist, name=track_artist, deleted=False)
-                track.artist = artist.id
-            elif album_artist:
-                artist = get_or_create(s, Artist, name=album_artist, deleted=False)
-                track.artist = artist.id
-
-            # If there is no track title or artist, try to parse the filename
-            if not track.title or not track.artist:
-                filename = os.path.splitext(os.path.basename(path))[0]
-                m_artist, m_title = match_track_filename(filename)
-                if not track.title and m_title:
-                    track.title = m_title
-                if not track.artist and m_artist:
-                    track.artist = m_artist
-
-            # Looks for album with given information
-            if album_title:
-                if album_artist:
-                    a_artist = get_or_create(s, Artist, name=album_artist, deleted=False)
-                else:
-                    a_artist = s.query(Artist).get(1)
-                
-                # Set album
-                try:
-                    album = s.query(Album).filter_by(title=album_title, artist=a_artist.id, deleted=False).one()
-                    track.album = album.id
-                except NoResultFound:
-                    album = Album(title=album_title, artist=a_artist.id, cover=1, is_audiobook=is_audiobook)
-                    s.add(album)
-                    s.commit()
-                    track.album = album.id
-
-        # Set dir
-        bpath = os.path.dirname(path)
-        mdir = get_or_create(s, Directory, directory=bpath, deleted=False)
-        track.dir = mdir.id
-                 
-        # Save everything
-        s.add(track)
-        s.commit()
+            # Tracks from before fingerprinting only have their size to compare against.
+            # Trust that once, and remember the fingerprint for the next scan.
+            if old_fingerprint is None and st.st_size == bytes_len and not deleted:
+                self._adopted.append((track_id, fingerprint))
+                return
 
-        # Check if we need to transcode
-        if track.type not in settings.NO_TRANSCODE_FORMATS:
-            self.transcode(s, track)
+        job = {
+            'path': path,
+            'ext': ext,
+            'is_audiobook': is_audiobook,
+            'bytes_len': st.st_size,
+            'fingerprint': fingerprint,
+            'track_id': track_id,
+        }
+
+        # Either read tags right here, or leave it for the worker pool. The pool is only used during a walk;
+        # single files from the watcher are quicker to read here.
+        if self._pool and self._seen is not None:
+            self._pending.append(job)
+            if len(self._pending) >= settings.SCAN_WORKERS * TAG_BATCH_SIZE:
+                self.flush_pending()
+        else:
+            self.store_audio(read_tags(job))
 
-        s.close()
+    def flush_pending(self):
+        """ Reads tags for all pending files in the worker pool, and stores the results as they come in. """
+        jobs = self._pending
+        self._pending = []
+        for record in self._pool.imap_unordered(read_tags, jobs, TAG_CHUNK_SIZE):
+            if not self._run:
+                return
+            self.store_audio(record)
 
-    def transcode(self, s, track):
-        at = audiotranscode.AudioTranscode()
-        stream = at.transcode_stream(track.file, settings.TRANSCODE_FORMAT)
-
-        cache_file = os.path.join(
-            settings.MUSIC_CACHE_DIRECTORY,
-            "{}.{}".format(track.id, settings.TRANSCODE_FORMAT))
-        with open(cache_file, 'wb') as f:
-            maxlen = 0
-            for data in stream:
-                f.write(data)
-                maxlen += len(data)
-            track.bytes_tc_len = maxlen
-            s.commit()
-            log.debug("Transcoded ID %d, result size was %d.", track.id, maxlen)
-
-    def preprocess_deleted(self):
-        s = session_get()
+    def store_audio(self, record):
+        self.transcode_written(self._writer.add(record))
 
-        log.debug(u"Removing deleted tracks from database ...")
-        for track in s.query(Track).filter_by(deleted=False):
-            if not os.path.isfile(track.file):
-                self.handle_track_delete(track)
-        log.debug(u"Removing deleted covers from database ...")
-        for cover in s.query(Cover).filter_by(deleted=False):
-            if cover.id == 1:
-                continue
-            if not os.path.isfile(cover.file):
-                self.handle_cover_delete(cover)
+    def flush_writer(self):
+        self.transcode_written(self._writer.flush())
+
+    def transcode_written(self, written):
+        """ Queues the freshly written tracks for transcoding, if their format requires it """
+        if settings.TRANSCODE_ON_DEMAND:
+            return
+        written = [track_id for track_id, track_type in written if track_type not in settings.NO_TRANSCODE_FORMATS]
+        if written:
+            enqueue_transcodes(written)
+            self._transcoder.wake()
+
+    def reconcile_deleted(self, roots):
+        """
+        Removes tracks and covers that were not seen during the walk from the index. Only files below the given
+        roots are considered, so that an unmounted directory doesn't empty the whole library.
+        """
+        prefixes = tuple(os.path.join(directory, u'') for directory in roots)
+        unreadable = tuple(self._unreadable)
+        if unreadable:
+            log.warning(u"Keeping the indexed files of %d paths that could not be read.", len(unreadable))
+
+        def missing(path):
+            return path not in self._seen and path.startswith(prefixes) and not path.startswith(unreadable)
+
+        tracks = [track_id for path, (track_id, fingerprint, bytes_len, deleted) in self._fingerprints.items()
+                  if not deleted and missing(path)]
+        s = session_get()
+        covers = [cover_id for cover_id, path in s.query(Cover.id, Cover.file).filter(Cover.deleted == False)
+                  if cover_id != 1 and missing(path)]
         s.close()
+        if tracks or covers:
+            log.info(u"Removing %d deleted tracks and %d deleted covers from database ...", len(tracks), len(covers))
+            self.delete_indexed(tracks, covers)
 
     def postprocess_albums(self):
+        """ Albums without an artist get the artist of their tracks, if all tracks have the same one """
         log.debug(u"Postprocessing albums ...")
         s = session_get()
-        found = 0
-        for album in s.query(Album).filter_by(deleted=False):
-            # Stop if quite is requested
-            if not self._run:
-                s.rollback()
-                return
-            # Just jump over PK 1, this is the unknown album
-            if album.id == 1:
-                continue
-            # skip albums that already have an artist
-            if album.artist != 1:
-                continue
-
-            # See if all tracks in album have matching artist
-            test = None
-            found_artist = True
-            for track in s.query(Track).filter_by(album=album.id):
-                if test is None:
-                    test = track.artist
-                else:
-                    if test != track.artist:
-                        found_artist = False
-
-            if found_artist:
-                # If we got here, all tracks in the album had the same artist.
-                # Therefore, set album artist as this.
-                found += 1
-                album.artist = test
-
+        # Albums whose tracks all have the same known artist. Unknown (PK 1) would change nothing.
+        single_artist = s.query(Track.album)\
+            .group_by(Track.album)\
+            .having(and_(func.count(distinct(Track.artist)) == 1, func.min(Track.artist) != 1))\
+            .subquery()
+        track_artist = select([func.min(Track.artist)]).where(Track.album == Album.id).as_scalar()
+
+        # Just jump over PK 1, this is the unknown album
+        found = s.query(Album)\
+            .filter(Album.id != 1, Album.artist == 1, Album.deleted == False, Album.id.in_(single_artist))\
+            .update({'artist': track_artist, 'updated': utc_now()}, synchronize_session=False)
+        if found:
+            bump_revisions(s, 'album')
         s.commit()
         s.close()
         log.debug(u"Found artist for %d new albums", found)
-            
+
     def postprocess_covers(self):
         log.debug(u"Postprocessing covers ...")
-        found = 0
         s = session_get()
+        found = {}  # album id -> (cover id, cover file)
         for album in s.query(Album).filter_by(deleted=False):
             # Stop if quit is requested
             if not self._run:
                 s.rollback()
+                s.close()
                 return
             # If album already has a cover, keep going
             if album.cover != 1:
@@ -271,46 +189,47 @@ class Scanner(object):
                 continue
 
             # Try to find cover art for this album
-            for track in s.query(Track).filter_by(album=album.id):
-                mdir = s.query(Directory).get(track.dir)
-                cover_art = self._cover_art.get(mdir.directory, None)
+            for directory, in s.query(Directory.directory).join(Track, Track.dir == Directory.id)\
+                    .filter(Track.album == album.id).distinct():
+                cover_art = self._cover_art.get(directory, None)
                 if cover_art:
                     cover = get_or_create(s, Cover, file=cover_art[0], deleted=False)
-                    found += 1
-
-                    # Make thumbnails
-                    try:
-                        img = Image.open(cover_art[0])
-                        size = 200, 200
-                        out_file = os.path.join(settings.COVER_CACHE_DIRECTORY, '{}_small.jpg'.format(cover.id))
-                        img.thumbnail(size, Image.ANTIALIAS)
-                        img.save(out_file, "JPEG")
-                    except IOError:
-                        log.error(u"Unable to create a small thumbnail for cover ID %d", cover.id)
-
-                    try:
-                        img = Image.open(cover_art[0])
-                        size = 800, 800
-                        out_file = os.path.join(settings.COVER_CACHE_DIRECTORY, '{}_medium.jpg'.format(cover.id))
-                        img.thumbnail(size, Image.ANTIALIAS)
-                        img.save(out_file, "JPEG")
-                    except IOError:
-                        log.error(u"Unable to create a medium thumbnail for cover ID %d", cover.id)
-
-                    # Set new cover id for album, and update tracks and the album timestamp for sync
-                    s.query(Track).filter_by(album=album.id).update({'updated': utc_now()})
-                    s.query(Album).filter_by(id=album.id).update({'updated': utc_now(), 'cover': cover.id})
+                    found[album.id] = cover.id, cover.file
 
                     # Cover lookup done for this album, continue with next
                     break
 
-        # That's that, commit changes for this album
+        # Covers are not synced to clients, so they can be saved right away.
+        # Albums are only updated once the thumbnails exist.
+        s.commit()
+        self.make_thumbnails(list(set(found.values())))
+
+        # Set new cover id for albums, and update tracks and the album timestamps for sync
+        for album_id, (cover_id, cover_file) in found.items():
+            s.query(Track).filter_by(album=album_id).update({'updated': utc_now()})
+            s.query(Album).filter_by(id=album_id).update({'updated': utc_now(), 'cover': cover_id})
+        if found:
+            bump_revisions(s, 'track', 'album')
+
+        # That's that, commit changes for the albums
         s.commit()
         s.close()
         self._cover_art = {}  # Clear cover art cache
-        log.debug(u"Found and attached %d new covers.", found)
+        log.debug(u"Found and attached %d new covers.", len(found))
+
+    def make_thumbnails(self, jobs):
+        """ Creates thumbnails for (cover id, file) pairs, in worker processes if there are any """
+        if not jobs:
+            return
+        if self._pool and len(jobs) > 1:
+            results = list(self._pool.imap_unordered(make_thumbnails, jobs))
+        else:
+            results = [make_thumbnails(job) for job in jobs]
+        for cover_id, error in results:
+            if error:
+                log.error(u"Unable to create thumbnails for cover ID %d: %s", cover_id, error)
 
-    def handle_cover(self, path, ext):
+    def handle_cover(self, path, ext, st):
         name = os.path.splitext(os.path.basename(path))[0]
         mdir = os.path.dirname(path)
         prev = [None, 0]
@@ -324,7 +243,7 @@ class Scanner(object):
         # TODO: Do this properly with eg. pillow
         for hint in settings.COVER_HINTS:
             if hint in name.lower():
-                size = os.path.getsize(path)
+                size = st.st_size
                 if size > prev[1]:
                     prev = [path, size]
 
@@ -332,34 +251,64 @@ class Scanner(object):
         if prev[0]:
             self._cover_art[mdir] = prev
 
-    def handle_track_delete(self, track):
+    def delete_indexed(self, track_ids, cover_ids):
+        """
+        Marks tracks and covers as deleted, along with the albums and artists that are left without tracks.
+        Everything is done with a few bulk statements in a single transaction.
+        """
         s = session_get()
-        
-        if track.album != 1:
-            # If album only has a single (this) track, remove album
-            if s.query(Track).filter_by(album=track.album, deleted=False).count() == 0:
-                s.query(Album).filter_by(id=track.album, deleted=False).update({'deleted': True, 'updated': utc_now()})
-                
-        if track.artist != 1:
-            # If artist only has a single (this) track, remove artist
-            if s.query(Track).filter_by(artist=track.artist, deleted=False).count() == 0:
-                s.query(Artist).filter_by(id=track.artist, deleted=False).update({'deleted': True, 'updated': utc_now()})
-
-        # That's that, delete the track.
-        s.query(Track).filter_by(id=track.id, deleted=False).update({'deleted': True, 'updated': utc_now()})
+        now = utc_now()
+
+        # Delete the tracks, and remember which albums and artists they belonged to
+        album_ids = set()
+        artist_ids = set()
+        for chunk in chunked(track_ids):
+            for album_id, artist_id in s.query(Track.album, Track.artist).filter(Track.id.in_(chunk)):
+                album_ids.add(album_id)
+                artist_ids.add(artist_id)
+            s.query(Track).filter(Track.id.in_(chunk), Track.deleted == False)\
+                .update({'deleted': True, 'updated': now}, synchronize_session=False)
+        album_ids.discard(1)
+        artist_ids.discard(1)
+
+        # Remove albums that no longer have any tracks
+        for chunk in chunked(album_ids):
+            orphans = s.query(Album.id, Album.title, Album.artist).filter(
+                Album.id.in_(chunk), Album.deleted == False,
+                ~exists().where(and_(Track.album == Album.id, Track.deleted == False))).all()
+            for album_id, title, artist_id in orphans:
+                self._identities.forget_album(title, artist_id)
+                self._identities.forget_album(title, 1)  # Artist may have been inferred afterwards
+            if orphans:
+                s.query(Album).filter(Album.id.in_([album_id for album_id, title, artist_id in orphans]))\
+                    .update({'deleted': True, 'updated': now}, synchronize_session=False)
+
+        # Remove artists that no longer have any tracks
+        for chunk in chunked(artist_ids):
+            orphans = s.query(Artist.id, Artist.name).filter(
+                Artist.id.in_(chunk), Artist.deleted == False,
+                ~exists().where(and_(Track.artist == Artist.id, Track.deleted == False))).all()
+            for artist_id, name in orphans:
+                self._identities.forget_artist(name)
+            if orphans:
+                s.query(Artist).filter(Artist.id.in_([artist_id for artist_id, name in orphans]))\
+                    .update({'deleted': True, 'updated': now}, synchronize_session=False)
+
+        # Clear references to removed covers from albums
+        for chunk in chunked(cover_ids):
+            s.query(Album).filter(Album.cover.in_(chunk), Album.deleted == False)\
+                .update({'cover': 1, 'updated': now}, synchronize_session=False)
+            s.query(Cover).filter(Cover.id.in_(chunk), Cover.deleted == False)\
+                .update({'deleted': True, 'updated': now}, synchronize_session=False)
 
         # Save changes
+        if track_ids:
+            bump_revisions(s, 'track', 'album', 'artist')
+        elif cover_ids:
+            bump_revisions(s, 'album')
         s.commit()
         s.close()
 
-    def handle_cover_delete(self, cover):
-        s = session_get()
-        for album in s.query(Album).filter_by(cover=cover.id, deleted=False):
-            album.cover = 1
-        s.query(Cover).filter_by(id=cover.id, deleted=False).update({'deleted': True, 'updated': utc_now()})
-        s.commit()
-        s.close()
-            
     def handle_delete(self, path):
         track = None
         cover = None
@@ -374,65 +323,166 @@ class Scanner(object):
             try:
                 cover = s.query(Cover).filter_by(file=path, deleted=False).one()
             except NoResultFound:
+                s.close()
+                self.handle_delete_dir(path)
                 return
         s.close()
 
         # If we found a cover, remove it and clear references to it from albums
         if cover:
-            self.handle_cover_delete(cover)
+            self.delete_indexed([], [cover.id])
             return
 
         # If we found a track, remove it from any albums. If the albums are now empty, remove them.
         # If artist does not belong to any track, remove it also
         if track:
-            self.handle_track_delete(track)
+            self.delete_indexed([track.id], [])
             return
 
-    def handle_file(self, path, is_audiobook):
-        ext = os.path.splitext(path)[1]
-        
-        if os.path.isfile(path):
-            # If file exists, scan it
-            if ext in settings.DAEMON_SCAN_FILES:
-                self.handle_audio(path, ext, is_audiobook)
-            if ext in settings.COVER_EXTENSIONS:
-                self.handle_cover(path, ext)
+    def handle_delete_dir(self, path):
+        """ Removes everything below a removed directory from the index """
+        prefix = os.path.join(path, u'')
+        # Not LIKE: that would take _ and % in the path as wildcards, and ignore case in SQLite
+        s = session_get()
+        tracks = [t for t, in s.query(Track.id).filter(
+            func.substr(Track.file, 1, len(prefix)) == prefix, Track.deleted == False)]
+        covers = [c for c, in s.query(Cover.id).filter(
+            func.substr(Cover.file, 1, len(prefix)) == prefix, Cover.deleted == False)]
+        s.close()
+        if tracks or covers:
+            self.delete_indexed(tracks, covers)
+
+    def handle_change(self, path, is_audiobook):
+        """ Handles a path reported as changed by the watcher """
+        if os.path.isdir(path):
+            self.traverse_dir(path, is_audiobook)
+        elif os.path.isfile(path):
+            self.handle_file(decode_path(path), is_audiobook)
         else:
-            self.handle_delete(path)
+            # Make sure a track we are about to delete is not waiting to be written
+            self.flush_writer()
+            self.handle_delete(decode_path(path))
+
+    def finish_changes(self):
+        """ Writes out everything found by handle_change, and runs the post-processing steps """
+        self.flush_writer()
+        self.adopt_fingerprints()
+        self.postprocess_albums()
+        self.postprocess_covers()
+
+    def handle_file(self, path, is_audiobook, st=None):
+        ext = os.path.splitext(path)[1]
+        if ext not in settings.DAEMON_SCAN_FILES and ext not in settings.COVER_EXTENSIONS:
+            return
+
+        # If the file no longer exists, make sure it is removed from the index
+        if st is None:
+            try:
+                st = os.stat(path)
+            except OSError:
+                self.handle_delete(path)
+                return
+        if not stat.S_ISREG(st.st_mode):
+            return
+        if self._seen is not None:
+            self._seen.add(path)
+
+        if ext in settings.DAEMON_SCAN_FILES:
+            self.handle_audio(path, ext, is_audiobook, st)
+        if ext in settings.COVER_EXTENSIONS:
+            self.handle_cover(path, ext, st)
+
+    def report_progress(self):
+        elapsed = max(time.time() - self._started, 0.001)
+        log.debug(u"%d files in %d directories handled (%.1f files/sec, %.1f dirs/sec).",
+                  self._files, self._dirs, self._files / elapsed, self._dirs / elapsed)
+
+    def mark_unreadable(self, path):
+        """ Remembers a path the walk could not read, so that its indexed files are not taken as deleted """
+        if self._unreadable is not None:
+            self._unreadable.add(path)
 
     def traverse_dir(self, directory, is_audiobook):
-        for dir_name, subdir_list, file_list in os.walk(directory):
+        # Walk the tree without recursion. Entries from scandir already know whether they are
+        # files or directories, so the only stat call left is the one for the files we are interested in.
+        stack = [directory]
+        while stack:
             if not self._run:
                 return
+            current = stack.pop()
+            dir_name = decode_path(current)
+            try:
+                # Listing may also fail halfway through, so read it all here
+                entries = list(scandir(current))
+            except OSError as e:
+                log.warning(u"Unable to list directory %s: %s", dir_name, e.strerror)
+                self.mark_unreadable(os.path.join(dir_name, u''))
+                continue
 
             self._dirs += 1
-
-            # Handle all files in this directory
-            for mfile in file_list:
+            for entry in entries:
                 if not self._run:
                     return
-                full_path = os.path.join(decode_path(dir_name), decode_path(mfile))
+                full_path = os.path.join(dir_name, decode_path(entry.name))
+                try:
+                    # Like os.walk, do not follow symlinked directories
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                        continue
+                    if not entry.is_file():
+                        continue
+                except OSError:
+                    # Could be a file or a directory
+                    self.mark_unreadable(full_path)
+                    continue
+
                 self._files += 1
                 if self._files % 500 == 0:
-                    log.debug(u"%d files handled.", self._files)
-                self.handle_file(full_path, is_audiobook)
+                    self.report_progress()
 
-            # Handle subdirs
-            for mdir in subdir_list:
-                self.traverse_dir(mdir, is_audiobook)
+                ext = os.path.splitext(full_path)[1]
+                if ext in settings.DAEMON_SCAN_FILES or ext in settings.COVER_EXTENSIONS:
+                    try:
+                        st = entry.stat()
+                    except OSError:
+                        self.mark_unreadable(full_path)
+                        continue
+                    self.handle_file(full_path, is_audiobook, st)
 
     def process_files(self):
         log.info(u"Scanning directory %s", settings.MUSIC_DIRECTORY)
         self._files = 0
         self._dirs = 0
+        self._started = time.time()
         self._cover_art = {}
-        self.traverse_dir(settings.MUSIC_DIRECTORY, False)
-        self.traverse_dir(settings.AUDIOBOOK_DIRECTORY, True)
-        log.info(u"Found %d files in %d directories.", self._files, self._dirs)
+        self._seen = set()
+        self._unreadable = set()
+        self.load_fingerprints()
+        self._identities.preload()
+        try:
+            walked = []
+            for directory, is_audiobook in self.scan_roots():
+                if os.path.isdir(directory):
+                    self.traverse_dir(directory, is_audiobook)
+                    walked.append(directory)
+                else:
+                    log.warning(u"Directory %s is not available, skipping it.", directory)
+            if self._pool and self._run:
+                self.flush_pending()
+            self.flush_writer()
+            if self._run:
+                self.reconcile_deleted(walked)
+        finally:
+            self._pending = []
+            self._fingerprints = None
+            self._seen = None
+            self._unreadable = None
+        self.adopt_fingerprints()
+        log.info(u"Found %d files in %d directories in %.1f seconds.",
+                 self._files, self._dirs, time.time() - self._started)
 
     def scan_all(self):
         log.info(u"Scanning everything ...")
-        self.preprocess_deleted()
         self.process_files()
         self.postprocess_albums()
         self.postprocess_covers()
@@ -440,25 +490,78 @@ class Scanner(object):
         log.info(u"Scan complete")
 
     def schedule_scan(self):
-        log.info(u"Scheduling a new scan after 30 minutes.")
-        self._update_task = task.deferLater(reactor, 1800, self.scan_all)
+        # When watching for changes, the full scan only needs to catch whatever the watcher missed.
+        interval = settings.SCAN_RECONCILE_INTERVAL if self._watcher else settings.SCAN_INTERVAL
+        log.info(u"Scheduling a new scan after %d minutes.", interval // 60)
+        self._update_task = task.deferLater(reactor, interval, self.scan_all)
+
+    def start_watching(self):
+        if not Watcher.available():
+            log.warning(u"inotify is not available, falling back to periodic scans.")
+            return
+        watcher = Watcher(self, settings.SCAN_WATCH_DELAY)
+        if watcher.start(self.scan_roots()):
+            self._watcher = watcher
+
+    @staticmethod
+    def scan_roots():
+        roots = [(settings.MUSIC_DIRECTORY, False), (settings.AUDIOBOOK_DIRECTORY, True)]
+        return [(directory, is_audiobook) for directory, is_audiobook in roots if directory]
 
     def __init__(self):
         self._cover_art = {}  # Save found cover files here
         self._files = 0
         self._dirs = 0
+        self._started = time.time()
         self._run = True
         self._update_task = None
+        self._pool = None  # Tag reader and thumbnail processes, if enabled; see start_workers()
+        self._pending = []  # Files waiting for the tag reader pool
+        self._fingerprints = None  # path -> (id, fingerprint, bytes_len, deleted) of known tracks during a scan
+        self._adopted = []  # (id, fingerprint) for unchanged tracks that had no fingerprint yet
+        self._seen = None  # Paths of the audio and cover files found during a walk
+        self._unreadable = None  # Directory prefixes and files the walk failed to read; their contents are unknown
+        self._identities = IdentityCache(settings.SCAN_CACHE_SIZE)
+        self._writer = TrackWriter(self._identities, settings.SCAN_BATCH_SIZE, settings.SCAN_BATCH_INTERVAL)
+        self._watcher = None
+        self._transcoder = TranscodeQueue(settings.TRANSCODE_WORKERS, settings.TRANSCODE_ATTEMPTS)
+
+    def start_workers(self):
+        """
+        Starts the processes that read tags and create thumbnails. They are kept for the lifetime of the scanner,
+        and must be started before any threads: a process forked while another thread holds a lock
+        (eg. the lock of a logging handler) gets a copy of the lock that is never released.
+        """
+        if settings.SCAN_WORKERS > 1:
+            log.info(u"Starting %d scanner worker processes.", settings.SCAN_WORKERS)
+            self._pool = multiprocessing.Pool(settings.SCAN_WORKERS, init_worker)
+
+    def stop_workers(self):
+        if self._pool:
+            self._pool.terminate()
+            self._pool.join()
+            self._pool = None
 
     def run(self):
-        log.info(u"Initial scan ...")
-        self.scan_all()
-        log.debug(u"Waiting for events ...")
-        reactor.run()
+        self.start_workers()
+        try:
+            # Start watching first, so that nothing changed during the initial scan gets missed.
+            if settings.SCAN_WATCH:
+                self.start_watching()
+            self._transcoder.start()
+            log.info(u"Initial scan ...")
+            self.scan_all()
+            log.debug(u"Waiting for events ...")
+            reactor.run()
+        finally:
+            self.stop_workers()
         log.debug(u'All done.')
 
     def stop(self):
         self._run = False
+        if self._watcher:
+            self._watcher.stop()
+        self._transcoder.stop()
         reactor.stop()
         log.info(u"Quitting ...")
 
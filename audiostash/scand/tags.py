@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+
+import os
+import signal
+import mutagen
+import logging
+
+from audiostash.common.utils import match_track_filename
+
+log = logging.getLogger(__name__)
+
+ARTIST_TAGS = ('TPE1', u'©ART', 'Author', 'Artist', 'ARTIST', 'TXXX:ARTIST',
+               'TRACK ARTIST', 'TRACKARTIST', 'TrackArtist', 'Track Artist',
+               'artist')
+ALBUM_ARTIST_TAGS = ('TPE2', u'aART', 'TXXX:ALBUM ARTIST', 'TXXX:ALBUMARTIST', 'ALBUM ARTIST',
+                     'ALBUMARTIST', 'AlbumArtist', 'Album Artist')
+ALBUM_TAGS = (u'©alb', 'TALB', 'ALBUM', 'album', 'TXXX:ALBUM')
+TITLE_TAGS = (u'©nam', 'TXXX:TITLE', 'TIT2', 'Title', 'TITLE', 'TRACK TITLE',
+              'TRACKTITLE', 'TrackTitle', 'Track Title')
+TRACK_TAGS = ('TRCK', 'TXXX:TRACK', 'Track', 'trkn', 'TRACK', 'tracknumber', 'TRACKNUMBER')
+DISC_TAGS = ('TXXX:DISCNUMBER', 'discnumber', 'DISCNUMBER', 'TPOS')
+GENRE_TAGS = ('TCON', u'@gen', 'gnre', 'Genre', 'genre', 'GENRE', 'TXXX:GENRE')
+DATE_TAGS = ('TYER', 'TDAT', 'TDRC', 'TDRL', u'@day', 'date', "DATE", "YEAR", "Date", "Year", 'TXXX:YEAR')
+
+
+def _get_tag(m, keys):
+    for tag in keys:
+        try:
+            return unicode(m[tag][0])
+        except KeyError:
+            pass
+        except ValueError:
+            pass
+    return u''
+
+
+def _get_tag_tuple(m, keys):
+    for tag in keys:
+        try:
+            return m[tag][0]
+        except KeyError:
+            pass
+        except ValueError:
+            pass
+    return None
+
+
+def _get_tag_number(m, keys):
+    """ Finds a track or disc number. These may be tuples (mp4) or strings like '3/12'. """
+    number = _get_tag_tuple(m, keys)
+    try:
+        if type(number) == tuple:
+            return int(number[0])
+        number = _get_tag(m, keys)
+        if '/' in number:
+            return int(number.split('/')[0])
+        elif number:
+            return int(number)
+    except ValueError:
+        pass
+    return None
+
+
+def init_worker():
+    """ Worker processes should leave signal handling to the scanner process. """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    try:
+        signal.signal(signal.SIGHUP, signal.SIG_DFL)
+        signal.signal(signal.SIGQUIT, signal.SIG_DFL)
+    except AttributeError:
+        pass
+
+
+def read_tags(job):
+    """
+    Reads tag information for a single audio file. Takes and returns plain dicts, so that
+    this can be run in a worker process. Resolving the results to database rows is left for the scanner.
+    """
+    record = dict(job)
+    record['tagged'] = False
+    path = job['path']
+
+    # Attempt to open up the file in Mutagen for tag information
+    m = None
+    try:
+        m = mutagen.File(path)
+    except:
+        log.warning(u"Could not read header for %s", path)
+    if not m:
+        return record
+
+    track_artist = _get_tag(m, ARTIST_TAGS)
+    album_artist = _get_tag(m, ALBUM_ARTIST_TAGS)
+    album_title = _get_tag(m, ALBUM_TAGS)
+    track_title = _get_tag(m, TITLE_TAGS)
+    track_number = _get_tag_number(m, TRACK_TAGS)
+
+    # Set track title, if found
+    if track_title:
+        title = track_title
+    elif track_number and album_title:
+        title = album_title + u" " + str(track_number)
+    elif track_number:
+        title = u"Track " + str(track_number)
+    else:
+        title = os.path.splitext(os.path.basename(path))[0]
+
+    # Prefer track artist, then album artist
+    artist = track_artist or album_artist
+
+    # If there is no track title or artist, try to parse the filename
+    if not title or not artist:
+        filename = os.path.splitext(os.path.basename(path))[0]
+        m_artist, m_title = match_track_filename(filename)
+        if not title and m_title:
+            title = m_title
+        if not artist and m_artist:
+            artist = m_artist
+
+    record.update({
+        'tagged': True,
+        'artist': artist,
+        'album_artist': album_artist,
+        'album': album_title,
+        'title': title,
+        'track': track_number,
+        'disc': _get_tag_number(m, DISC_TAGS),
+        'genre': _get_tag(m, GENRE_TAGS),
+        'date': _get_tag(m, DATE_TAGS),
+    })
+    return record
@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+
+import os
+import logging
+import threading
+import multiprocessing
+
+from audiostash.common import audiotranscode
+from audiostash.common.tables import session_get, Track, TranscodeJob
+from audiostash.common.transcache import cache_file_path, enqueue_transcodes, TranscodeCache
+from audiostash import settings
+
+log = logging.getLogger(__name__)
+
+# Seconds an idle worker waits before checking the queue again
+POLL_INTERVAL = 5
+
+
+class TranscodeQueue(object):
+    """
+    Transcodes tracks in the background. Jobs are kept in the transcodejob table, so that they survive restarts.
+    A number of worker threads pick jobs by priority and run the decoder/encoder pipelines. Failed jobs are
+    retried until they run out of attempts.
+    """
+    def __init__(self, workers, attempts):
+        self._workers = workers or multiprocessing.cpu_count()
+        self._attempts = attempts
+        self._threads = []
+        self._lock = threading.Lock()
+        self._cache = TranscodeCache(settings.MUSIC_CACHE_SIZE)
+        self._wakeup = threading.Event()
+        self._run = False
+
+    @staticmethod
+    def enqueue_missing():
+        """ Adds jobs for all tracks that need transcoding, but are not transcoded or queued yet. """
+        # With a limited cache, evicted tracks are left alone until someone plays them again.
+        if settings.TRANSCODE_ON_DEMAND or settings.MUSIC_CACHE_SIZE:
+            return
+        s = session_get()
+        queued = s.query(TranscodeJob.track)
+        missing = [t for t, in s.query(Track.id).filter(
+            Track.deleted == False,
+            Track.bytes_tc_len == 0,
+            ~Track.type.in_(settings.NO_TRANSCODE_FORMATS),
+            ~Track.id.in_(queued))]
+        s.close()
+        if missing:
+            log.info(u"Queueing %d tracks that have not been transcoded yet.", len(missing))
+            enqueue_transcodes(missing)
+
+    def start(self):
+        # Anything left running belongs to the previous process; put those back in line
+        s = session_get()
+        s.query(TranscodeJob).filter_by(running=True).update({'running': False})
+        s.commit()
+        s.close()
+        self.enqueue_missing()
+
+        self._run = True
+        for i in range(self._workers):
+            thread = threading.Thread(target=self._work, name="transcoder-{}".format(i))
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+        log.info(u"Started %d transcoder workers.", self._workers)
+
+    def stop(self):
+        self._run = False
+        self._wakeup.set()
+
+    def wake(self):
+        self._wakeup.set()
+
+    def _claim(self):
+        """ Marks the next job as running and returns (job id, track id), or None if there is nothing to do. """
+        with self._lock:
+            s = session_get()
+            try:
+                job = s.query(TranscodeJob)\
+                    .filter(TranscodeJob.running == False, TranscodeJob.attempts < self._attempts)\
+                    .order_by(TranscodeJob.priority.desc(), TranscodeJob.id).first()
+                if not job:
+                    return None
+                job.running = True
+                job.attempts += 1
+                claimed = job.id, job.track
+                s.commit()
+                return claimed
+            finally:
+                s.close()
+
+    def _release(self, job_id):
+        """ Puts a job back in line after an unexpected error """
+        s = session_get()
+        try:
+            s.query(TranscodeJob).filter_by(id=job_id).update({'running': False})
+            s.commit()
+        except Exception:
+            log.exception(u"Unable to release transcode job ID %d.", job_id)
+        finally:
+            s.close()
+
+    def _work(self):
+        while self._run:
+            self._wakeup.clear()
+            claimed = None
+            try:
+                claimed = self._claim()
+                if claimed:
+                    self._process(*claimed)
+                    continue
+            except Exception:
+                # Eg. database locked by the scanner; keep the worker alive and try again a bit later.
+                log.exception(u"Error in transcoder worker.")
+                if claimed:
+                    self._release(claimed[0])
+            self._wakeup.wait(POLL_INTERVAL)
+
+    def _process(self, job_id, track_id):
+        s = session_get()
+        try:
+            job = s.query(TranscodeJob).get(job_id)
+            track = s.query(Track).get(track_id)
+
+            # Track may have been removed after queueing
+            if not track or track.deleted:
+                s.delete(job)
+                s.commit()
+                return
+
+            try:
+                size = self.transcode(track)
+            except Exception as e:
+                log.error(u"Transcoding track ID %d failed (attempt %d/%d): %s",
+                          track_id, job.attempts, self._attempts, e)
+                job.running = False
+                job.error = unicode(e)
+                s.commit()
+                return
+
+            s.query(Track).filter_by(id=track_id).update({
+                'bytes_tc_len': size,
+                'updated': Track.updated  # Not interesting for clients; don't trigger a sync
+            })
+            s.delete(job)
+            s.commit()
+        finally:
+            s.close()
+        log.debug(u"Transcoded ID %d, result size was %d.", track_id, size)
+
+        with self._lock:
+            self._cache.maybe_enforce()
+
+    @staticmethod
+    def transcode(track):
+        """ Transcodes into a temporary file first, so that a half-done file is never served. """
+        at = audiotranscode.AudioTranscode()
+        stream = at.transcode_stream(track.file, settings.TRANSCODE_FORMAT)
+
+        cache_file = cache_file_path(track.id)
+        temp_file = cache_file + '.part'
+        size = 0
+        try:
+            with open(temp_file, 'wb') as f:
+                for data in stream:
+                    f.write(data)
+                    size += len(data)
+            if size == 0:
+                raise audiotranscode.TranscodeError("Transcoder produced no data")
+        except:
+            os.remove(temp_file)
+            raise
+        os.rename(temp_file, cache_file)
+        return size
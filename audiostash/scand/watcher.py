@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+
+import os
+import logging
+from functools import partial
+
+from twisted.internet import reactor
+from twisted.python.filepath import FilePath
+
+try:
+    from twisted.internet import inotify
+except ImportError:
+    inotify = None
+
+log = logging.getLogger(__name__)
+
+
+class Watcher(object):
+    """
+    Watches the music directories with inotify, and feeds the changed paths to the scanner.
+    Events for a path are debounced, so that a file being copied in is only scanned once
+    it has been left alone for a while. Once all events have been handled, the scanner
+    is asked to finish up (write out tracks, find album artists and covers).
+    """
+    def __init__(self, scanner, delay):
+        self._scanner = scanner
+        self._delay = delay
+        self._notifier = None
+        self._watched = set()
+        self._pending = {}  # path -> DelayedCall
+        self._settle = None
+        self._mask = 0
+        if inotify:
+            self._mask = inotify.IN_CREATE | inotify.IN_MODIFY | inotify.IN_CLOSE_WRITE | \
+                inotify.IN_DELETE | inotify.IN_MOVED_FROM | inotify.IN_MOVED_TO
+
+    @staticmethod
+    def available():
+        return inotify is not None
+
+    def start(self, roots):
+        """ Starts watching. Roots is a list of (directory, is_audiobook) tuples. Returns False on failure. """
+        try:
+            self._notifier = inotify.INotify()
+            self._notifier.startReading()
+            for directory, is_audiobook in roots:
+                self._watch_tree(directory, is_audiobook)
+        except inotify.INotifyError as e:
+            log.error(u"Unable to watch the music directories: %s", e)
+            self.stop()
+            return False
+        log.info(u"Watching %d directories for changes.", len(self._watched))
+        return True
+
+    def stop(self):
+        for call in self._pending.values():
+            if call.active():
+                call.cancel()
+        self._pending = {}
+        if self._settle and self._settle.active():
+            self._settle.cancel()
+        if self._notifier:
+            self._notifier.loseConnection()
+            self._notifier = None
+        self._watched = set()
+
+    def _watch_tree(self, directory, is_audiobook):
+        callbacks = [partial(self._on_event, is_audiobook)]
+        for dir_name, subdir_list, file_list in os.walk(directory):
+            if dir_name not in self._watched:
+                self._notifier.watch(FilePath(dir_name), mask=self._mask, callbacks=callbacks)
+                self._watched.add(dir_name)
+
+    def _unwatch_tree(self, directory):
+        prefix = os.path.join(directory, '')
+        for path in [p for p in self._watched if p == directory or p.startswith(prefix)]:
+            self._watched.discard(path)
+            try:
+                self._notifier.ignore(FilePath(path))
+            except KeyError:
+                pass  # Already removed along with the directory
+
+    def _on_event(self, is_audiobook, ignored, filepath, mask):
+        path = filepath.path
+        if mask & inotify.IN_ISDIR:
+            if mask & (inotify.IN_CREATE | inotify.IN_MOVED_TO):
+                try:
+                    self._watch_tree(path, is_audiobook)
+                except inotify.INotifyError as e:
+                    log.error(u"Unable to watch new directory: %s", e)
+            elif mask & (inotify.IN_DELETE | inotify.IN_MOVED_FROM):
+                self._unwatch_tree(path)
+            else:
+                return
+        elif not mask & self._mask:
+            return
+        self._schedule(path, is_audiobook)
+
+    def _schedule(self, path, is_audiobook):
+        call = self._pending.get(path)
+        if call and call.active():
+            call.reset(self._delay)
+        else:
+            self._pending[path] = reactor.callLater(self._delay, self._fire, path, is_audiobook)
+
+    def _fire(self, path, is_audiobook):
+        del self._pending[path]
+        try:
+            self._scanner.handle_change(path, is_audiobook)
+        except Exception:
+            log.exception(u"Error while handling a change.")
+
+        # Let the scanner finish up after things have calmed down
+        if self._settle and self._settle.active():
+            self._settle.reset(self._delay)
+        else:
+            self._settle = reactor.callLater(self._delay, self._finish)
+
+    def _finish(self):
+        if self._pending:
+            self._settle = reactor.callLater(self._delay, self._finish)
+            return
+        self._scanner.finish_changes()
@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import logging
+from collections import OrderedDict
+
+from audiostash.common.tables import session_get, bump_revisions, Track, Album, Directory, Artist
+from audiostash.common.utils import utc_now, chunked
+
+log = logging.getLogger(__name__)
+
+
+class TrackWriter(object):
+    """
+    Buffers tag records from the scanner, and writes them to the database in batches.
+    Each batch resolves its artists, albums and directories from the identity cache and a few set queries,
+    inserts the missing ones in bulk and then writes all tracks, all in a single transaction.
+    """
+    def __init__(self, identities, batch_size, batch_interval):
+        self._identities = identities
+        self._batch_size = batch_size
+        self._batch_interval = batch_interval
+        self._records = OrderedDict()
+        self._last_flush = time.time()
+
+    def __len__(self):
+        return len(self._records)
+
+    def add(self, record):
+        """ Adds a record, and flushes if the batch is full or old enough. Returns whatever flush returns. """
+        self._records[record['path']] = record
+        if len(self._records) >= self._batch_size or time.time() - self._last_flush >= self._batch_interval:
+            return self.flush()
+        return []
+
+    def _resolve_artists(self, s, names, now):
+        cache = self._identities.artists
+        ids = {}
+        for name in names:
+            artist_id = cache.get(name)
+            if artist_id is not None:
+                ids[name] = artist_id
+        for chunk in chunked(name for name in names if name not in ids):
+            for artist_id, name in s.query(Artist.id, Artist.name)\
+                    .filter(Artist.name.in_(chunk), Artist.deleted == False):
+                ids.setdefault(name, artist_id)
+        new = [Artist(name=name, deleted=False, updated=now) for name in names if name not in ids]
+        if new:
+            s.bulk_save_objects(new, return_defaults=True)
+            for artist in new:
+                ids[artist.name] = artist.id
+        for name, artist_id in ids.items():
+            cache.put(name, artist_id)
+        return ids
+
+    def _resolve_directories(self, s, paths, now):
+        cache = self._identities.directories
+        ids = {}
+        for path in paths:
+            dir_id = cache.get(path)
+            if dir_id is not None:
+                ids[path] = dir_id
+        for chunk in chunked(path for path in paths if path not in ids):
+            for dir_id, directory in s.query(Directory.id, Directory.directory)\
+                    .filter(Directory.directory.in_(chunk), Directory.deleted == False):
+                ids.setdefault(directory, dir_id)
+        new = [Directory(directory=path, deleted=False, updated=now) for path in paths if path not in ids]
+        if new:
+            s.bulk_save_objects(new, return_defaults=True)
+            for mdir in new:
+                ids[mdir.directory] = mdir.id
+        for path, dir_id in ids.items():
+            cache.put(path, dir_id)
+        return ids
+
+    def _resolve_albums(self, s, keys, now):
+        """ Keys are (title, artist_id) pairs, mapped to is_audiobook flags for new albums """
+        cache = self._identities.albums
+        ids = {}
+        for key in keys:
+            album_id = cache.get(key)
+            if album_id is not None:
+                ids[key] = album_id
+        for chunk in chunked(set(title for title, artist_id in keys if (title, artist_id) not in ids)):
+            for album_id, title, artist_id in s.query(Album.id, Album.title, Album.artist)\
+                    .filter(Album.title.in_(chunk), Album.deleted == False):
+                if (title, artist_id) in keys:
+                    ids.setdefault((title, artist_id), album_id)
+        new = [Album(title=title, artist=artist_id, cover=1, is_audiobook=is_audiobook, deleted=False, updated=now)
+               for (title, artist_id), is_audiobook in keys.items() if (title, artist_id) not in ids]
+        if new:
+            s.bulk_save_objects(new, return_defaults=True)
+            for album in new:
+                ids[(album.title, album.artist)] = album.id
+        for key, album_id in ids.items():
+            cache.put(key, album_id)
+        return ids
+
+    def flush(self):
+        """ Writes all buffered records. Returns a list of (track id, type) for the written tracks. """
+        self._last_flush = time.time()
+        if not self._records:
+            return []
+        records = self._records.values()
+        self._records = OrderedDict()
+
+        s = session_get()
+        try:
+            written = self._write(s, records)
+            s.commit()
+        except:
+            # Ids of rows created in this batch are no longer valid
+            s.rollback()
+            self._identities.clear()
+            raise
+        finally:
+            s.close()
+        return written
+
+    def _write(self, s, records):
+        now = utc_now()
+
+        # Resolve all foreign keys first. Missing rows get created here.
+        names = set()
+        for record in records:
+            if record['tagged']:
+                if record['artist']:
+                    names.add(record['artist'])
+                if record['album_artist']:
+                    names.add(record['album_artist'])
+        artist_ids = self._resolve_artists(s, names, now)
+        dir_ids = self._resolve_directories(s, set(os.path.dirname(r['path']) for r in records), now)
+        album_keys = {}
+        for record in records:
+            if record['tagged'] and record['album']:
+                a_artist = artist_ids[record['album_artist']] if record['album_artist'] else 1
+                album_keys.setdefault((record['album'], a_artist), record['is_audiobook'])
+        album_ids = self._resolve_albums(s, album_keys, now)
+
+        # Then create or update the tracks themselves
+        new_tracks = []
+        updates = []
+        for record in records:
+            values = {
+                'bytes_len': record['bytes_len'],
+                'bytes_tc_len': 0,
+                'fingerprint': record['fingerprint'],
+                'dir': dir_ids[os.path.dirname(record['path'])],
+                'deleted': False,
+                'updated': now,
+            }
+            if record['tagged']:
+                values.update({
+                    'title': record['title'],
+                    'track': record['track'],
+                    'disc': record['disc'],
+                    'genre': record['genre'],
+                    'date': record['date'],
+                })
+                if record['artist']:
+                    values['artist'] = artist_ids[record['artist']]
+                if record['album']:
+                    a_artist = artist_ids[record['album_artist']] if record['album_artist'] else 1
+                    values['album'] = album_ids[(record['album'], a_artist)]
+
+            if record['track_id']:
+                values['id'] = record['track_id']
+                updates.append(values)
+            else:
+                values.setdefault('album', 1)
+                values.setdefault('artist', 1)
+                new_tracks.append(Track(file=record['path'], type=record['ext'][1:], **values))
+
+        if updates:
+            s.bulk_update_mappings(Track, updates)
+        if new_tracks:
+            s.bulk_save_objects(new_tracks, return_defaults=True)
+        bump_revisions(s, 'track', 'album', 'artist')
+
+        log.debug(u"Wrote %d new and %d changed tracks.", len(new_tracks), len(updates))
+        written = [(t.id, t.type) for t in new_tracks]
+        written.extend((r['track_id'], r['ext'][1:]) for r in records if r['track_id'])
+        return written
@@ -7,6 +7,24 @@ BASEDIR = os.path.dirname(os.path.abspath(__file__))
 # Port for the server.
 PORT = 8000
 
+# Number of threads the server uses for database queries. Requests that need the database
+# wait in line when all threads are busy; streaming continues meanwhile.
+DB_WORKERS = 4
+
+# Seconds the server trusts a session key it has already checked, before checking it from the database again.
+SESSION_CACHE_TTL = 60
+
+# Let nginx send track and cover files (X-Accel-Redirect), instead of passing them through the server.
+# Requires the internal locations from deploy/audiostash.nginx, with their aliases set to the directories below.
+ACCEL_REDIRECT = False
+
+# Also create WebP versions of cover thumbnails, and send them to browsers that support them.
+COVER_WEBP = False
+
+# Bytes of cover thumbnails the server keeps in memory, and seconds browsers may cache cover images.
+COVER_MEMORY_CACHE_SIZE = 32 * 1024 * 1024
+COVER_MAX_AGE = 30 * 86400
+
 # Debug mode.
 # If true, the daemons will print on commandline instead of logfile.
 # Set False for production, True for development.
@@ -20,6 +38,16 @@ MUSIC_DIRECTORY = "/mnt/music"
 # On windows, please use slashes instead of backslashes (eg. C:/music/)
 AUDIOBOOK_DIRECTORY = None
 
+# Watch the music and audiobook directories for changes (linux only, uses inotify).
+# Changed files are scanned after they have been left alone for SCAN_WATCH_DELAY seconds.
+SCAN_WATCH = True
+SCAN_WATCH_DELAY = 5
+
+# Seconds between full rescans. When watching for changes, the full rescan only needs
+# to catch changes the watcher missed, and SCAN_RECONCILE_INTERVAL is used instead.
+SCAN_INTERVAL = 1800
+SCAN_RECONCILE_INTERVAL = 86400
+
 # Image cache directory
 # Make sure this is not inside or the same as MUSIC_DIRECTORY
 COVER_CACHE_DIRECTORY = '/mnt/tmp/cover'
@@ -28,6 +56,11 @@ COVER_CACHE_DIRECTORY = '/mnt/tmp/cover'
 # Make sure this is not inside or the same as MUSIC_DIRECTORY
 MUSIC_CACHE_DIRECTORY = '/mnt/tmp/music'
 
+# Maximum size of the transcoded file cache in bytes (eg. 50 * 1024**3), or None for no limit.
+# When the cache is full, the least recently played tracks are removed from it. They are transcoded
+# again when played, so this works best with TRANSCODE_ON_DEMAND.
+MUSIC_CACHE_SIZE = None
+
 # Cover filename hints (looks for eg. cover_*.<ext> in album path.
 COVER_HINTS = [
     'cover',
@@ -62,10 +95,49 @@ NO_TRANSCODE_FORMATS = [
     'ogg'
 ]
 
+# Number of worker processes used for reading tags while scanning.
+# With 1, tags are read in the scanner process itself. Set to eg. the number of
+# CPU cores to speed up large initial scans.
+SCAN_WORKERS = 1
+
+# Scanned tracks are written to the database in batches of this many tracks,
+# or after this many seconds have passed since the last batch, whichever comes first.
+SCAN_BATCH_SIZE = 500
+SCAN_BATCH_INTERVAL = 10
+
+# How many artists, albums and directories the scanner keeps in its in-memory lookup cache (each).
+SCAN_CACHE_SIZE = 50000
+
+# Maximum number of rows sent to a client in a single sync message.
+SYNC_PAGE_SIZE = 1000
+
+# Compress websocket messages (permessage-deflate), if the browser supports it. Makes syncing a lot
+# faster on slow connections, at the cost of some CPU time and memory per connection.
+WEBSOCKET_COMPRESSION = True
+
+# How often (in seconds) the server checks the database for changes made by other processes (eg. the scanner).
+# Connected clients are told about the changed tables, so they don't need to poll. Processes normally
+# notify each other of changes through NOTIFY_SOCKET_DIRECTORY, so this is only a fallback.
+SYNC_CHECK_INTERVAL = 30
+
+# Directory for the unix sockets used by the scanner and the server to notify each other of changes.
+# Set to None to disable (the server then only notices changes every SYNC_CHECK_INTERVAL seconds).
+NOTIFY_SOCKET_DIRECTORY = os.path.join(BASEDIR, "run")
+
 # Format to transcode to
 # Note: Currently does not work with other formats! Do not change!
 TRANSCODE_FORMAT = 'mp3'
 
+# Transcode tracks only when they are first played, instead of transcoding everything in the background.
+# The first listener gets the track streamed while it is being transcoded.
+TRANSCODE_ON_DEMAND = False
+
+# Number of tracks transcoded in parallel in the background. None uses the number of CPU cores.
+TRANSCODE_WORKERS = None
+
+# How many times a failing transcode is attempted before giving up on it.
+TRANSCODE_ATTEMPTS = 3
+
 # Logfile for the daemon. If debugmode is on, then stdout will be used for log output.
 # If this value points to a logfile, that will be used.
 
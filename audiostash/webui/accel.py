@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+
+import os
+import urllib
+
+from audiostash import settings
+
+# Internal nginx locations for the directories files are served from. These must match deploy/audiostash.nginx.
+LOCATIONS = [
+    (settings.MUSIC_DIRECTORY, '/internal/music/'),
+    (settings.AUDIOBOOK_DIRECTORY, '/internal/audiobooks/'),
+    (settings.MUSIC_CACHE_DIRECTORY, '/internal/transcoded/'),
+    (settings.COVER_CACHE_DIRECTORY, '/internal/covers/'),
+]
+
+
+def accel_uri(path):
+    """ Finds the internal nginx URI for a file, or None if the file is not in any of the served directories """
+    for directory, location in LOCATIONS:
+        if not directory:
+            continue
+        prefix = os.path.join(os.path.abspath(directory), '')
+        path = os.path.abspath(path)
+        if path.startswith(prefix):
+            relative = path[len(prefix):]
+            if isinstance(relative, unicode):
+                relative = relative.encode('utf-8')
+            return location + urllib.quote(relative.replace(os.sep, '/'))
+    return None
+
+
+def accel_redirect(handler, path):
+    """
+    Hands the file over to nginx, which then serves it (including ranges) straight from the disk.
+    Returns False if the file can't be handed over, and should be served by the handler itself.
+    """
+    uri = accel_uri(path)
+    if not uri:
+        return False
+    handler.set_header("X-Accel-Redirect", uri)
+    handler.finish()
+    return True
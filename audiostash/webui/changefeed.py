@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+
+import socket
+import logging
+
+from audiostash.common import notify
+from audiostash.common.tables import session_get, Revision
+from audiostash.webui.dbexecutor import run_in_executor
+from tornado import gen
+from tornado.ioloop import IOLoop, PeriodicCallback
+
+log = logging.getLogger(__name__)
+
+
+@run_in_executor
+def load_revisions():
+    s = session_get()
+    revisions = dict(s.query(Revision.name, Revision.revision))
+    s.close()
+    return revisions
+
+
+class ChangeFeed(object):
+    """
+    Watches the revisions of the synced tables, and tells the listeners which tables have changed.
+    This is a single small query per check for the whole server, however many clients are connected.
+    Checks are run when another process sends a notification, and every interval seconds as a fallback.
+    """
+    def __init__(self):
+        self._revisions = None
+        self._listeners = []
+        self._checking = False
+        self._again = False
+        self._sock = None
+
+    def listen(self, callback):
+        """ Callback gets a dict of changed table names and their new revisions """
+        self._listeners.append(callback)
+
+    def start(self, interval):
+        self._sock = notify.bind('webui')
+        if self._sock:
+            IOLoop.current().add_handler(self._sock.fileno(), self._on_notify, IOLoop.READ)
+        else:
+            log.info(u"Change notifications are not available, checking for changes every %d seconds.", interval)
+        PeriodicCallback(self.check, interval * 1000).start()
+        return self.check()
+
+    def stop(self):
+        if self._sock:
+            IOLoop.current().remove_handler(self._sock.fileno())
+            notify.unbind(self._sock)
+            self._sock = None
+
+    def _on_notify(self, fd, events):
+        # Any number of notifications are handled with a single check
+        try:
+            while self._sock.recv(64):
+                pass
+        except socket.error:
+            pass
+        self.check()
+
+    @gen.coroutine
+    def check(self):
+        """ Looks for changes now. If a check is already running, it runs once more when done. """
+        if self._checking:
+            self._again = True
+            return
+        self._checking = True
+        try:
+            self._again = True
+            while self._again:
+                self._again = False
+                self._update((yield load_revisions()))
+        finally:
+            self._checking = False
+
+    def _update(self, revisions):
+        old = self._revisions
+        self._revisions = revisions
+        if old is None:
+            return
+        changed = dict((name, revision) for name, revision in revisions.items() if old.get(name) != revision)
+        if changed:
+            log.debug(u"Tables changed: %s", u", ".join(changed.keys()))
+            for callback in self._listeners:
+                callback(changed)
+
+
+changes = ChangeFeed()
@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+
+from collections import OrderedDict
+
+# Sync data formats. Clients ask for one in their sync requests; old clients don't, and get objects.
+FORMATS = ('objects', 'columns')
+
+
+class _Normalizer(object):
+    """ Replaces embedded rows with their ids, and collects each embedded row once """
+    def __init__(self):
+        self.related = {}  # column name -> OrderedDict of id -> normalized row
+        self.ref_columns = {}  # column name -> set of ref columns of the related rows
+
+    def normalize(self, row, refs):
+        out = {}
+        for key, value in row.items():
+            if isinstance(value, dict) and 'id' in value:
+                found = self.related.setdefault(key, OrderedDict())
+                if value['id'] not in found:
+                    found[value['id']] = self.normalize(value, self.ref_columns.setdefault(key, set()))
+                out[key] = value['id']
+                refs.add(key)
+            else:
+                out[key] = value
+        return out
+
+
+def _block(rows, refs):
+    names = OrderedDict()
+    for row in rows:
+        for key in row:
+            names[key] = True
+    return {
+        'count': len(rows),
+        'columns': dict((name, [row.get(name) for row in rows]) for name in names),
+        'refs': sorted(refs),
+    }
+
+
+def encode_columns(rows):
+    """
+    Encodes serialized rows in a compact, columnar form. Rows that are embedded in other rows (eg. the album
+    and artist of a track) are sent once in 'related', and replaced by their ids. A block of rows is
+    {'count': number of rows, 'columns': {name: [values]}, 'refs': [names of columns that hold related ids]}.
+    The result is a block for the rows, with a 'related' dict of column name -> block.
+    """
+    normalizer = _Normalizer()
+    refs = set()
+    rows = [normalizer.normalize(row, refs) for row in rows]
+    block = _block(rows, refs)
+    block['related'] = dict(
+        (name, _block(found.values(), normalizer.ref_columns.get(name, ())))
+        for name, found in normalizer.related.items())
+    return block
+
+
+def encode(rows, fmt):
+    """ Encodes serialized rows in the given format """
+    if fmt == 'columns':
+        return encode_columns(rows)
+    return rows
@@ -5,45 +5,59 @@ import os
 import mimetypes
 import logging
 
-from audiostash.common.tables import session_get, Cover, Session
+from audiostash.common.cache import ByteLRUCache
+from audiostash.common.tables import session_get, Cover
+from audiostash.common.thumbnails import thumbnail_path
+from audiostash.webui.sessioncache import sessions
+from audiostash.webui.dbexecutor import run_in_executor
+from audiostash.webui.accel import accel_redirect
 from tornado import web, gen
-from sqlalchemy.orm.exc import NoResultFound
 
 log = logging.getLogger(__name__)
 
+# Thumbnails by (file, mtime, size), so that changed files are not served from memory
+_thumbnails = ByteLRUCache(settings.COVER_MEMORY_CACHE_SIZE)
+
+
+@run_in_executor
+def find_cover(session_id, cover_id):
+    """ Returns (session is valid, cover or None if it doesn't exist) """
+    s = session_get()
+    try:
+        if not sessions.is_valid(s, session_id):
+            return False, None
+        return True, s.query(Cover).filter_by(id=cover_id).first()
+    finally:
+        s.close()
+
 
 class CoverHandler(web.RequestHandler):
     @web.asynchronous
     @gen.coroutine
     def get(self, session_id, size_flag, cover_id):
-        s = session_get()
-
-        # Make sure session is valid
-        try:
-            s.query(Session).filter_by(key=session_id).one()
-        except NoResultFound:
-            s.close()
+        # Make sure session is valid, and find the cover we want
+        valid, cover = yield find_cover(session_id, cover_id)
+        if not valid:
             self.set_status(401)
             self.finish("401")
-            log.warning(u"Cover ID %d requested without a valid session.", cover_id)
+            log.warning(u"Cover ID %s requested without a valid session.", cover_id)
             return
-
-        # Find the cover we want
-        try:
-            cover = s.query(Cover).filter_by(id=cover_id).one()
-        except NoResultFound:
-            s.close()
+        if not cover:
             self.set_status(404)
             self.finish("404")
             log.warning(u"Cover ID %s does not exist.", cover_id)
             return
 
-        s.close()
-
-        if size_flag == "0":
-            cover_file = os.path.join(settings.COVER_CACHE_DIRECTORY, "{}_small.jpg".format(cover.id))
-        elif size_flag == "1":
-            cover_file = os.path.join(settings.COVER_CACHE_DIRECTORY, "{}_medium.jpg".format(cover.id))
+        if size_flag in ("0", "1"):
+            # Thumbnails. Send the WebP version to browsers that take it, if there is one.
+            name = "small" if size_flag == "0" else "medium"
+            cover_file = thumbnail_path(cover.id, name)
+            if settings.COVER_WEBP:
+                self.set_header("Vary", "Accept")
+                if "image/webp" in self.request.headers.get("Accept", ""):
+                    webp_file = thumbnail_path(cover.id, name, 'webp')
+                    if os.path.isfile(webp_file):
+                        cover_file = webp_file
         else:
             # Make sure we have a filename
             if not cover.file:
@@ -54,18 +68,42 @@ class CoverHandler(web.RequestHandler):
 
             cover_file = cover.file
 
-        # Just pick content type and dump out the file.
-        self.set_header("Content-Type", mimetypes.guess_type("file://"+cover_file)[0])
         try:
-            with file(cover_file, 'rb') as f:
-                ret = yield gen.Task(self.get_data, f)
-                self.write(ret)
-        except IOError:
+            st = os.stat(cover_file)
+        except OSError:
             self.set_status(404)
             self.finish("404")
-            log.warning(u"Matching file for cover ID %d does not exist.", cover_id)
+            log.warning(u"Matching file for cover ID %s does not exist.", cover_id)
+            return
+
+        # Cover files rarely change once generated, so let browsers and proxies keep them.
+        # Just pick content type and dump out the file, or let nginx do it.
+        self.set_header("Content-Type", mimetypes.guess_type("file://"+cover_file)[0])
+        self.set_header("Cache-Control", "public, max-age={}".format(settings.COVER_MAX_AGE))
+        if settings.ACCEL_REDIRECT and accel_redirect(self, cover_file):
+            return
+        self.set_header("Etag", '"{}-{}-{}-{}"'.format(cover.id, os.path.basename(cover_file), st.st_size,
+                                                       int(st.st_mtime)))
+        if self.check_etag_header():
+            self.set_status(304)
+            self.finish()
             return
 
+        key = (cover_file, st.st_mtime, st.st_size)
+        data = _thumbnails.get(key)
+        if data is None:
+            try:
+                with file(cover_file, 'rb') as f:
+                    data = yield gen.Task(self.get_data, f)
+            except IOError:
+                self.set_status(404)
+                self.finish("404")
+                log.warning(u"Matching file for cover ID %s does not exist.", cover_id)
+                return
+            if size_flag in ("0", "1"):
+                _thumbnails.put(key, data)
+
+        self.write(data)
         self.finish()
 
     def get_data(self, handle, callback):
@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import threading
+from functools import wraps
+
+from audiostash import settings
+from concurrent.futures import ThreadPoolExecutor
+
+log = logging.getLogger(__name__)
+
+
+class DBExecutor(object):
+    """
+    Runs blocking database work in a bounded pool of threads, so that the IOLoop is left to do I/O only.
+    Submitted calls return futures that can be yielded from coroutines. Keeps count of the calls
+    that are waiting for a free thread, so that a backed up pool can be noticed.
+    """
+    def __init__(self, workers):
+        self.workers = workers
+        self._executor = ThreadPoolExecutor(workers)
+        self._lock = threading.Lock()
+        self._queued = 0
+        self._running = 0
+        self._peak = 0
+
+    def submit(self, fn, *args, **kwargs):
+        with self._lock:
+            self._queued += 1
+            self._peak = max(self._peak, self._queued)
+        return self._executor.submit(self._run, fn, args, kwargs)
+
+    def _run(self, fn, args, kwargs):
+        with self._lock:
+            self._queued -= 1
+            self._running += 1
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            with self._lock:
+                self._running -= 1
+
+    def stats(self):
+        """ Returns queued and running calls right now, and the peak queue depth since the last call """
+        with self._lock:
+            stats = {
+                'queued': self._queued,
+                'running': self._running,
+                'peak': self._peak,
+            }
+            self._peak = self._queued
+        return stats
+
+    def log_stats(self):
+        stats = self.stats()
+        level = logging.WARNING if stats['peak'] >= self.workers else logging.DEBUG
+        log.log(level, u"Database executor: %d queued, %d running, peak queue depth %d.",
+                stats['queued'], stats['running'], stats['peak'])
+
+
+executor = DBExecutor(settings.DB_WORKERS)
+
+
+def run_in_executor(fn):
+    """ Makes fn run in the database executor. Calling it returns a future for the result. """
+    @wraps(fn)
+    def wrapper(*args, **kwargs):
+        return executor.submit(fn, *args, **kwargs)
+    return wrapper
@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+
+import os
+import logging
+import threading
+
+from audiostash import settings
+from audiostash.common import audiotranscode
+from audiostash.common.tables import session_get, Track
+from audiostash.common.transcache import cache_file_path, TranscodeCache
+from audiostash.webui.dbexecutor import executor
+from tornado import gen, locks
+from tornado.ioloop import IOLoop
+
+log = logging.getLogger(__name__)
+
+_cache = TranscodeCache(settings.MUSIC_CACHE_SIZE)
+
+
+class LiveTranscode(object):
+    """
+    A transcode that is being streamed to listeners while it runs. The encoder output is written to a
+    temporary file in the cache directory, which the listeners follow as it grows. When the transcode
+    finishes, the file is moved in place in the cache and the track is marked as transcoded.
+    All listeners of a track share the same transcode.
+    """
+    _running = {}  # track id -> LiveTranscode
+
+    @classmethod
+    def get(cls, track_id, source_file):
+        """ Finds the running transcode for the track, or starts a new one """
+        live = cls._running.get(track_id)
+        if not live:
+            live = cls(track_id, source_file)
+            cls._running[track_id] = live
+            live.start()
+        return live
+
+    def __init__(self, track_id, source_file):
+        self.track_id = track_id
+        self.source_file = source_file
+        self.cache_file = cache_file_path(track_id)
+        self.temp_file = "{}.{}.live".format(self.cache_file, os.getpid())  # Workers may transcode the same track
+        self.size = 0
+        self.done = False
+        self.error = None
+        self._changed = locks.Condition()
+        self._io_loop = IOLoop.current()
+
+        # Create the file right away, so that listeners can open it before the encoder gets going.
+        self._output = open(self.temp_file, 'wb')
+
+    def start(self):
+        log.info(u"Starting on-demand transcode of track ID %d.", self.track_id)
+        thread = threading.Thread(target=self._transcode, name="live-{}".format(self.track_id))
+        thread.daemon = True
+        thread.start()
+
+    def open(self):
+        """ Opens the output for reading. The handle stays valid after the file is moved into the cache. """
+        return open(self.cache_file if self.done and not self.error else self.temp_file, 'rb')
+
+    @gen.coroutine
+    def wait(self, offset):
+        """ Waits until there is data available after offset, or the transcode has ended """
+        while self.size <= offset and not self.done:
+            yield self._changed.wait()
+
+    def _transcode(self):
+        # Runs in its own thread; all state changes are passed back to the IOLoop.
+        try:
+            at = audiotranscode.AudioTranscode()
+            with self._output as f:
+                for data in at.transcode_stream(self.source_file, settings.TRANSCODE_FORMAT):
+                    f.write(data)
+                    f.flush()
+                    self._io_loop.add_callback(self._progress, len(data))
+        except Exception as e:
+            self._io_loop.add_callback(self._finish, e)
+        else:
+            self._io_loop.add_callback(self._finish, None)
+
+    def _progress(self, length):
+        self.size += length
+        self._changed.notify_all()
+
+    def _finish(self, error):
+        if error is None and self.size == 0:
+            error = audiotranscode.TranscodeError("Transcoder produced no data")
+
+        if error is None:
+            try:
+                os.rename(self.temp_file, self.cache_file)
+            except OSError as e:
+                error = e
+
+        if error is None:
+            # Stay in _running until the size is stored, so that nobody starts transcoding the track again
+            self._io_loop.add_future(executor.submit(self._store), self._stored)
+            log.info(u"On-demand transcode of track ID %d done, result size was %d.", self.track_id, self.size)
+        else:
+            del self._running[self.track_id]
+            self.error = error
+            try:
+                os.remove(self.temp_file)
+            except OSError:
+                pass
+            log.error(u"On-demand transcode of track ID %d failed: %s", self.track_id, error)
+
+        self.done = True
+        self._changed.notify_all()
+
+    def _stored(self, future):
+        del self._running[self.track_id]
+        if future.exception() is not None:
+            log.error(u"Unable to store the size of on-demand transcoded track ID %d: %s",
+                      self.track_id, future.exception())
+
+    def _store(self):
+        # Runs in the database executor
+        s = session_get()
+        s.query(Track).filter_by(id=self.track_id).update({
+            'bytes_tc_len': self.size,
+            'updated': Track.updated  # Not interesting for clients; don't trigger a sync
+        })
+        s.commit()
+        s.close()
+        _cache.maybe_enforce()
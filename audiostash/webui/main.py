@@ -7,16 +7,21 @@ import argparse
 import sys
 
 from audiostash.common.tables import database_init
-from tornado import web, ioloop
+from tornado import web, ioloop, netutil, process, httpserver
 from sockjs.tornado import SockJSRouter
 from audiostash.webui.sockethandler import AudioStashSock
 from audiostash.webui.trackhandler import TrackHandler
 from audiostash.webui.coverhandler import CoverHandler
+from audiostash.webui.dbexecutor import executor
+from audiostash.webui.changefeed import changes
+from audiostash.webui.transports import with_compression
 
 
 if __name__ == '__main__':
     # Handle arguments
     parser = argparse.ArgumentParser(description="Audiostash Web UI server")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="Number of server processes. 0 starts one for each CPU. (default: 1)")
     args = parser.parse_args()
 
     # Find correct log level
@@ -50,17 +55,33 @@ if __name__ == '__main__':
     log.info(u"Public path = %s", settings.PUBLIC_PATH)
     log.info(u"Server port = %s", settings.PORT)
 
+    # Bind the port before forking, so that all workers accept connections from the same socket.
+    # Database connections, threads, the IOLoop and notification sockets must all be created after the fork.
+    sockets = netutil.bind_sockets(settings.PORT)
+    if args.workers != 1:
+        try:
+            process.fork_processes(args.workers)
+        except KeyboardInterrupt:
+            sys.exit(0)
+        log.info(u"Worker %d started.", process.task_id())
+
     # Set up database
     database_init(settings.DATABASE_CONFIG)
 
     # Set up mimetypes
     mimetypes.init()
+    mimetypes.add_type('image/webp', '.webp')
 
-    # SockJS interface
-    router = SockJSRouter(AudioStashSock, '/sock')
+    # SockJS interface. SockJS sessions live in the process that created them, and the polling and
+    # streaming transports send each request of a session separately; those could land on any worker.
+    sockjs_settings = {}
+    if args.workers != 1:
+        sockjs_settings['disabled_transports'] = ['xhr', 'xhr_streaming', 'jsonp', 'eventsource', 'htmlfile']
+    router = SockJSRouter(AudioStashSock, '/sock', user_settings=sockjs_settings)
+    sock_urls = with_compression(router.urls) if settings.WEBSOCKET_COMPRESSION else router.urls
 
     # Index and static handlers
-    handlers = router.urls + [
+    handlers = sock_urls + [
         (r'/track/([a-z0-9]+)/(\d+).mp3$', TrackHandler),
         (r'/cover/([a-z0-9]+)/(\d)/(\d+)$', CoverHandler),
         (r'/(.*)$', web.StaticFileHandler, {'path': settings.PUBLIC_PATH, 'default_filename': 'index.html'}),
@@ -68,14 +89,19 @@ if __name__ == '__main__':
 
     conf = {
         'debug': settings.DEBUG,
+        'autoreload': settings.DEBUG and args.workers == 1,  # Does not work with multiple processes
     }
 
     # Start up everything
     app = web.Application(handlers, **conf)
-    app.listen(settings.PORT)
+    server = httpserver.HTTPServer(app)
+    server.add_sockets(sockets)
     loop = ioloop.IOLoop.instance()
+    ioloop.PeriodicCallback(executor.log_stats, 60000).start()
+    changes.start(settings.SYNC_CHECK_INTERVAL)
     try:
         loop.start()
     except KeyboardInterrupt:
         loop.stop()
+    changes.stop()
     log.info(u"Stopping AudioStash server.")
@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+
+import time
+import threading
+
+from audiostash import settings
+from audiostash.common.cache import LRUCache
+from audiostash.common.tables import Session
+from audiostash.webui.changefeed import changes
+
+
+class SessionCache(object):
+    """
+    Remembers session keys that were recently found valid, for ttl seconds. Used by the HTTP handlers,
+    which get a request for every range of a track and every cover image. Logging out removes the key.
+    Safe to use from the database executor threads.
+    """
+    def __init__(self, ttl, capacity=1024):
+        self.ttl = ttl
+        self._keys = LRUCache(capacity)  # key -> expiry time
+        self._lock = threading.Lock()
+
+    def is_valid(self, s, key):
+        """ Checks the key against the cache, and then against the database using session s """
+        now = time.time()
+        with self._lock:
+            expires = self._keys.get(key)
+        if expires is not None and expires > now:
+            return True
+        if s.query(Session).filter_by(key=key).count() == 0:
+            return False
+        with self._lock:
+            self._keys.put(key, now + self.ttl)
+        return True
+
+    def forget(self, key):
+        with self._lock:
+            self._keys.pop(key)
+
+    def clear(self):
+        with self._lock:
+            self._keys.clear()
+
+    def revisions_changed(self, revisions):
+        # Sessions were removed, possibly by another server process. Logouts are rare, so just start over.
+        if 'session' in revisions:
+            self.clear()
+
+
+sessions = SessionCache(settings.SESSION_CACHE_TTL)
+changes.listen(sessions.revisions_changed)
@@ -1,17 +1,157 @@
 # -*- coding: utf-8 -*-
 
 import json
+import pytz
 import logging
 
 from passlib.hash import pbkdf2_sha256
+from audiostash import settings
 from audiostash.common.tables import \
-    session_get, Artist, Album, Playlist, PlaylistItem, Track, Setting, Session, User
+    session_get, serialize_rows, bump_revisions, SYNC_TABLES, Artist, Album, Playlist, PlaylistItem, Track, Setting, \
+    Session, User
 from audiostash.common.utils import generate_session, to_isodate, from_isodate, utc_now, utc_minus_delta
+from audiostash.webui.dbexecutor import run_in_executor
+from audiostash.webui.sessioncache import sessions
+from audiostash.webui.changefeed import changes
+from audiostash.webui.compact import FORMATS, encode
 from sockjs.tornado import SockJSConnection
+from tornado import gen, locks
+from sqlalchemy import and_, or_
 from sqlalchemy.orm.exc import NoResultFound
 
 log = logging.getLogger(__name__)
 
+# Sync protocol versions. Version 1 embeds the related rows (eg. album and artist of a track) in each row;
+# version 2 sends the ids only, and the client joins the rows itself. Clients that don't say get version 1.
+SYNC_VERSIONS = (1, 2)
+
+
+@run_in_executor
+def find_session(sid):
+    s = session_get()
+    try:
+        session = s.query(Session).filter_by(key=sid).one()
+        return s.query(User).filter_by(id=session.user).one()
+    except NoResultFound:
+        return None
+    finally:
+        s.close()
+
+
+@run_in_executor
+def login(username, password):
+    """ Checks the credentials, and creates a session. Returns (user, session id), or None on failure. """
+    s = session_get()
+    try:
+        user = s.query(User).filter_by(username=username).one()
+        if not pbkdf2_sha256.verify(password, user.password):
+            return None
+        session_id = generate_session()
+        s.add(Session(key=session_id, user=user.id))
+        s.commit()
+        s.refresh(user)
+        return user, session_id
+    except NoResultFound:
+        return None
+    finally:
+        s.close()
+
+
+@run_in_executor
+def logout(sid):
+    s = session_get()
+    s.query(Session).filter_by(key=sid).delete()
+    bump_revisions(s, 'session')  # Other server processes may have the session cached
+    s.commit()
+    s.close()
+
+
+@run_in_executor
+def add_playlist(name):
+    """ Creates a new playlist. Returns False if the name is already taken. """
+    s = session_get()
+    try:
+        if s.query(Playlist).filter_by(name=name, deleted=False).count() > 0:
+            return False
+        s.add(Playlist(name=name, updated=utc_now()))
+        bump_revisions(s, 'playlist')
+        s.commit()
+        return True
+    finally:
+        s.close()
+
+
+@run_in_executor
+def del_playlist(playlist_id):
+    s = session_get()
+    s.query(PlaylistItem).filter_by(playlist=playlist_id, deleted=False).update({
+        'deleted': True,
+        'updated': utc_now()
+    })
+    s.query(Playlist).filter_by(id=playlist_id).update({
+        'deleted': True,
+        'updated': utc_now()
+    })
+    bump_revisions(s, 'playlist', 'playlistitem')
+    s.commit()
+    s.close()
+
+
+@run_in_executor
+def copy_playlist(from_id, to_id):
+    s = session_get()
+    s.query(PlaylistItem).filter_by(playlist=to_id, deleted=False).update({
+        'deleted': True,
+        'updated': utc_now()
+    })
+    s.commit()
+
+    for item in s.query(PlaylistItem).filter_by(playlist=from_id, deleted=False):
+        plitem = PlaylistItem(track=item.track, playlist=to_id, number=item.number, updated=utc_now())
+        s.add(plitem)
+    bump_revisions(s, 'playlistitem')
+    s.commit()
+    s.close()
+
+
+@run_in_executor
+def save_playlist(playlist_id, track_ids):
+    s = session_get()
+    s.query(PlaylistItem).filter_by(playlist=playlist_id, deleted=False).update({
+        'deleted': True,
+        'updated': utc_now()
+    })
+
+    k = 0
+    for track_id in track_ids:
+        plitem = PlaylistItem(track=track_id, playlist=playlist_id, number=k, updated=utc_now())
+        s.add(plitem)
+        k += 1
+    bump_revisions(s, 'playlistitem')
+    s.commit()
+    s.close()
+
+
+@run_in_executor
+def sync_page(table, remote_ts, remote_id, limit, fmt, version):
+    """ Serializes at most limit rows after the cursor. Returns (encoded rows, cursor ts, cursor id, more). """
+    s = session_get()
+    rows = s.query(table)\
+        .filter(or_(table.updated > remote_ts, and_(table.updated == remote_ts, table.id > remote_id)))\
+        .order_by(table.updated, table.id)\
+        .limit(limit + 1)\
+        .all()
+    more = len(rows) > limit
+    rows = rows[:limit]
+    if rows:
+        remote_ts = rows[-1].updated
+        remote_id = rows[-1].id
+        if remote_ts.tzinfo is None:
+            remote_ts = pytz.utc.localize(remote_ts)
+    data = encode(serialize_rows(s, rows, flat=version >= 2), fmt)
+    s.close()
+    return data, remote_ts, remote_id, more
+
 
 class AudioStashSock(SockJSConnection):
     clients = set()
@@ -20,6 +160,9 @@ class AudioStashSock(SockJSConnection):
         self.authenticated = False
         self.sid = None
         self.ip = None
+        self.sync_format = 'objects'  # As asked by the client in its sync requests; used for pushes too
+        self.sync_version = 1
+        self._lock = locks.Lock()  # Messages are handled one at a time, in order
         super(AudioStashSock, self).__init__(session)
 
     def send_error(self, mtype, message, code):
@@ -49,21 +192,13 @@ class AudioStashSock(SockJSConnection):
         self.clients.add(self)
         log.debug(u"Connection accepted from %s", info.ip)
 
+    @gen.coroutine
     def on_auth_msg(self, packet_msg):
         sid = packet_msg.get('sid', '')
-
-        s = session_get()
-        user = None
-        session = None
-        try:
-            session = s.query(Session).filter_by(key=sid).one()
-            user = s.query(User).filter_by(id=session.user).one()
-        except NoResultFound:
-            pass
-        s.close()
+        user = yield find_session(sid)
 
         # Session found with token.
-        if session and user:
+        if user:
             self.sid = sid
             self.authenticated = True
 
@@ -79,27 +214,15 @@ class AudioStashSock(SockJSConnection):
         self.send_error('auth', "Invalid session", 403)
         log.warning(u"Authentication failed.")
 
+    @gen.coroutine
     def on_login_msg(self, packet_msg):
         username = packet_msg.get('username', '')
         password = packet_msg.get('password', '')
 
-        s = session_get()
-        try:
-            user = s.query(User).filter_by(username=username).one()
-        except NoResultFound:
-            self.send_error('login', 'Incorrect username or password', 401)
-            log.warning(u"Invalid username or password in login request.")
-            s.close()
-            return
-
         # If user exists and password matches, pass onwards!
-        if user and pbkdf2_sha256.verify(password, user.password):
-            session_id = generate_session()
-
-            # Add new session
-            ses = Session(key=session_id, user=user.id)
-            s.add(ses)
-            s.commit()
+        result = yield login(username, password)
+        if result:
+            user, session_id = result
 
             # Mark connection as authenticated, and save session id
             self.sid = session_id
@@ -120,14 +243,11 @@ class AudioStashSock(SockJSConnection):
             self.send_error('login', 'Incorrect username or password', 401)
             log.warning(u"Invalid username or password in login request.")
 
-        s.close()
-
+    @gen.coroutine
     def on_logout_msg(self, packet_msg):
         # Remove session
-        s = session_get()
-        s.query(Session).filter_by(key=self.sid).delete()
-        s.commit()
-        s.close()
+        yield logout(self.sid)
+        sessions.forget(self.sid)
 
         # Dump out log
         log.info(u"Logged out '%s'.", self.sid)
@@ -136,48 +256,35 @@ class AudioStashSock(SockJSConnection):
         self.authenticated = False
         self.sid = None
 
+    @gen.coroutine
     def on_playlist_msg(self, packet_msg):
         if not self.authenticated:
             return
 
         query = packet_msg.get('query', '')
 
+        # Writes below bump the table revisions; changes.check() lets the other clients know right away.
+
         # Creates a new playlist with a given name. Errors out if the name already exists.
         if query == 'add_playlist':
             name = packet_msg.get('name')
-
-            s = session_get()
-
-            if s.query(Playlist).filter_by(name=name, deleted=False).count() > 0:
+            if (yield add_playlist(name)):
+                changes.check()
+                yield self.sync_table('playlist', Playlist, utc_minus_delta(5), push=True)
+                log.debug(u"A new playlist created!")
+            else:
                 self.send_error('playlist', "Playlist with given name already exists", 500)
                 log.warning(u"Playlist with given name already exists.")
-            else:
-                playlist = Playlist(name=name, updated=utc_now())
-                s.add(playlist)
-                s.commit()
-                self.sync_table('playlist', Playlist, utc_minus_delta(5), push=True)
-                log.debug(u"A new playlist created!")
-
-            s.close()
             return
 
         # Delete playlist and all related items
         if query == 'del_playlist':
             playlist_id = packet_msg.get('id')
             if id > 1:
-                s = session_get()
-                s.query(PlaylistItem).filter_by(playlist=playlist_id, deleted=False).update({
-                    'deleted': True,
-                    'updated': utc_now()
-                })
-                s.query(Playlist).filter_by(id=playlist_id).update({
-                    'deleted': True,
-                    'updated': utc_now()
-                })
-                s.commit()
-                s.close()
-                self.sync_table('playlist', Playlist, utc_minus_delta(5), push=True)
-                self.sync_table('playlistitem', PlaylistItem, utc_minus_delta(5), push=True)
+                yield del_playlist(playlist_id)
+                changes.check()
+                yield self.sync_table('playlist', Playlist, utc_minus_delta(5), push=True)
+                yield self.sync_table('playlistitem', PlaylistItem, utc_minus_delta(5), push=True)
                 self.notify_playlist_changes(playlist_id)
                 log.debug(u"Playlist and items deleted!")
                 return
@@ -185,20 +292,9 @@ class AudioStashSock(SockJSConnection):
         # Copy scratchpad playlist (id 1) to a new playlist
         if query == 'copy_scratchpad':
             to_id = packet_msg.get('id')
-            s = session_get()
-            s.query(PlaylistItem).filter_by(playlist=to_id, deleted=False).update({
-                'deleted': True,
-                'updated': utc_now()
-            })
-            s.commit()
-
-            for item in s.query(PlaylistItem).filter_by(playlist=1, deleted=False):
-                plitem = PlaylistItem(track=item.track, playlist=to_id, number=item.number, updated=utc_now())
-                s.add(plitem)
-            s.commit()
-            s.close()
-
-            self.sync_table('playlistitem', PlaylistItem, utc_minus_delta(5), push=True)
+            yield copy_playlist(1, to_id)
+            changes.check()
+            yield self.sync_table('playlistitem', PlaylistItem, utc_minus_delta(5), push=True)
             self.notify_playlist_changes(to_id)
             log.debug(u"Playlist copied!")
             return
@@ -207,22 +303,9 @@ class AudioStashSock(SockJSConnection):
         if query == 'save_playlist':
             playlist_id = packet_msg.get('id')
             items = packet_msg.get('tracks')
-
-            s = session_get()
-            s.query(PlaylistItem).filter_by(playlist=playlist_id, deleted=False).update({
-                'deleted': True,
-                'updated': utc_now()
-            })
-
-            k = 0
-            for item in items:
-                plitem = PlaylistItem(track=item['id'], playlist=playlist_id, number=k, updated=utc_now())
-                s.add(plitem)
-                k += 1
-            s.commit()
-            s.close()
-
-            self.sync_table('playlistitem', PlaylistItem, utc_minus_delta(5), push=True)
+            yield save_playlist(playlist_id, [item['id'] for item in items])
+            changes.check()
+            yield self.sync_table('playlistitem', PlaylistItem, utc_minus_delta(5), push=True)
             self.notify_playlist_changes(playlist_id)
             log.debug(u"Playlist updated!")
             return
@@ -234,18 +317,49 @@ class AudioStashSock(SockJSConnection):
             'push': True,
         })
 
-    def sync_table(self, name, table, remote_ts, push=False):
-        # Send message containing all new data in the table
-        s = session_get()
-        self.send_message('sync', {
-            'query': 'request',
-            'table': name,
-            'ts': to_isodate(utc_now()),
-            'push': push,
-            'data': [t.serialize() for t in s.query(table).filter(table.updated > remote_ts)]
-        })
-        s.close()
+    @classmethod
+    def broadcast_changes(cls, revisions):
+        """ Tells all logged in clients which tables have changed, so that they can sync them """
+        tables = dict((name, revision) for name, revision in revisions.items() if name in SYNC_TABLES)
+        if not tables:
+            return
+        for client in cls.clients:
+            if client.authenticated:
+                client.send_message('sync', {
+                    'query': 'changed',
+                    'tables': tables,
+                })
+
+    @gen.coroutine
+    def sync_table(self, name, table, remote_ts, remote_id=0, limit=None, push=False, paged=True):
+        """
+        Sends the rows changed after the client's (updated, id) cursor, in that order, at most limit rows
+        per message. Each message carries the cursor of its last row, and tells whether there are more rows.
+        The client asks for the next page with that cursor, so an interrupted sync can be resumed.
+        Pushes are sent all at once, as are syncs for clients that don't send a cursor id: with only
+        a timestamp, they could never get past a page of rows that share one.
+        """
+        # LIMIT with a negative value means no limit at all
+        limit = max(1, min(int(limit or settings.SYNC_PAGE_SIZE), settings.SYNC_PAGE_SIZE))
+        more = True
+        while more:
+            data, remote_ts, remote_id, more = yield sync_page(
+                table, remote_ts, remote_id, limit, self.sync_format, self.sync_version)
+            self.send_message('sync', {
+                'query': 'request',
+                'table': name,
+                'ts': to_isodate(remote_ts),
+                'id': remote_id,
+                'more': more,
+                'push': push,
+                'format': self.sync_format,
+                'version': self.sync_version,
+                'data': data
+            })
+            if paged and not push:
+                break
 
+    @gen.coroutine
     def on_sync_msg(self, packet_msg):
         if not self.authenticated:
             return
@@ -254,12 +368,16 @@ class AudioStashSock(SockJSConnection):
         if query == 'request':
             name = packet_msg.get('table')
 
-            # Attempt to parse timestamp received from the client.
+            # Attempt to parse the cursor received from the client.
             try:
                 remote_ts = from_isodate(packet_msg.get('ts'))
+                remote_id = int(packet_msg.get('id', 0))
+                limit = packet_msg.get('limit', 0)
+                if isinstance(limit, bool) or not isinstance(limit, (int, long)):
+                    raise ValueError("Limit is not an integer")
             except:
-                self.send_error('sync', "Invalid timestamp", 400)
-                log.warning(u"Invalid timestamp in sync request.")
+                self.send_error('sync', "Invalid cursor or limit", 400)
+                log.warning(u"Invalid cursor or limit in sync request.")
                 return
 
             # Find table model that matches the name
@@ -272,15 +390,34 @@ class AudioStashSock(SockJSConnection):
                     'playlist': Playlist,
                     'playlistitem': PlaylistItem
                 }[name]
-                self.sync_table(name, table, remote_ts)
             except KeyError:
                 self.send_error('sync', "Invalid table name", 400)
                 log.warning(u"Invalid table name in sync request.")
                 return
 
+            fmt = packet_msg.get('format', 'objects')
+            if fmt not in FORMATS:
+                self.send_error('sync', "Invalid format", 400)
+                log.warning(u"Invalid format in sync request.")
+                return
+            try:
+                version = int(packet_msg.get('version', 1))
+            except (TypeError, ValueError):
+                version = None
+            if version not in SYNC_VERSIONS:
+                self.send_error('sync', "Unsupported version", 400)
+                log.warning(u"Unsupported version in sync request.")
+                return
+
+            self.sync_format = fmt
+            self.sync_version = version
+            yield self.sync_table(name, table, remote_ts, remote_id, limit, paged='id' in packet_msg)
+
+    @gen.coroutine
     def on_unknown_msg(self, packet_msg):
         log.debug(u"Unknown or nonexistent packet type!")
 
+    @gen.coroutine
     def on_message(self, raw_message):
         # Load packet and parse as JSON
         try:
@@ -308,9 +445,13 @@ class AudioStashSock(SockJSConnection):
             'playlist': self.on_playlist_msg,
             'unknown': self.on_unknown_msg
         }
-        cbs[packet_type if packet_type in cbs else 'unknown'](packet_msg)
+        with (yield self._lock.acquire()):
+            yield cbs[packet_type if packet_type in cbs else 'unknown'](packet_msg)
 
     def on_close(self):
         self.clients.remove(self)
         log.debug(u"Connection closed")
         return super(AudioStashSock, self).on_close()
+
+
+changes.listen(AudioStashSock.broadcast_changes)
@@ -5,105 +5,218 @@ import os
 import mimetypes
 import logging
 
-from audiostash.common.tables import session_get, Track, Session
-from tornado import web, gen
+from audiostash.common.tables import session_get, Track
+from tornado import web, gen, httputil
 from tornado.httputil import HTTPOutputError
-from sqlalchemy.orm.exc import NoResultFound
+from tornado.iostream import StreamClosedError
+from audiostash.webui.livetranscode import LiveTranscode
+from audiostash.webui.accel import accel_redirect
+from audiostash.webui.sessioncache import sessions
+from audiostash.webui.dbexecutor import executor, run_in_executor
+from audiostash.common.transcache import cache_file_path, enqueue_transcodes, touch, PLAY_PRIORITY
 
 log = logging.getLogger(__name__)
 
 
+@run_in_executor
+def find_track(session_id, song_id):
+    """ Returns (session is valid, track or None if it doesn't exist) """
+    s = session_get()
+    try:
+        if not sessions.is_valid(s, session_id):
+            return False, None
+        return True, s.query(Track).filter_by(id=song_id).first()
+    finally:
+        s.close()
+
+
+def track_file(song):
+    """ Returns the file to send for a track, and its content type """
+    if song.type in settings.NO_TRANSCODE_FORMATS:
+        return song.file, mimetypes.guess_type("file://"+song.file)[0]
+    return cache_file_path(song.id), "audio/mpeg"
+
+
+def track_validators(song, size):
+    """
+    Returns a strong ETag and a Last-Modified date for a track. Both come from the source file, since the
+    modification time of a transcoded file is its last play time.
+    """
+    try:
+        mtime = int(os.stat(song.file).st_mtime)
+    except OSError:
+        mtime = 0
+    return '"{}-{}-{}"'.format(song.id, size, mtime), httputil.format_timestamp(mtime)
+
+
+def parse_range(header, size):
+    """
+    Parses a Range header for a file of the given size. Returns an inclusive (start, end) pair, or None if the
+    whole file should be sent. Raises ValueError if the range can't be satisfied.
+    Headers that can't be parsed are ignored, as are multiple ranges; serving those would need a multipart response.
+    """
+    if not header or not header.startswith('bytes=') or ',' in header:
+        return None
+    start, sep, end = header[6:].strip().partition('-')
+    try:
+        start = int(start) if start else None
+        end = int(end) if end else None
+    except ValueError:
+        return None
+    if not sep or (start is None and end is None) or (end is not None and end < 0):
+        return None
+    if start is None:
+        # Suffix range, the last N bytes
+        if end == 0 or size == 0:
+            raise ValueError("Empty suffix range")
+        return max(size - end, 0), size-1
+    if end is not None and end < start:
+        return None
+    if start >= size:
+        raise ValueError("Range starts after the end of the file")
+    return start, size-1 if end is None else min(end, size-1)
+
+
 class TrackHandler(web.RequestHandler):
     @web.asynchronous
     @gen.coroutine
     def get(self, session_id, song_id):
-        s = session_get()
-
-        # Make sure session is valid
-        try:
-            s.query(Session).filter_by(key=session_id).one()
-        except NoResultFound:
-            s.close()
+        # Make sure session is valid, and find the song we want
+        valid, song = yield find_track(session_id, song_id)
+        if not valid:
             self.set_status(401)
             self.finish("401")
-            log.warning(u"Track ID %d requested without a valid session.", song_id)
+            log.warning(u"Track ID %s requested without a valid session.", song_id)
             return
-
-        # Find the song we want
-        try:
-            song = s.query(Track).filter_by(id=song_id).one()
-        except NoResultFound:
-            s.close()
+        if not song:
             self.set_status(404)
             self.finish("404")
-            log.warning(u"Nonexistent track ID %d requested.", song_id)
+            log.warning(u"Nonexistent track ID %s requested.", song_id)
             return
 
-        s.close()
+        # Not transcoded yet, or evicted from the cache.
+        # Either transcode now and stream while it runs, or ask the scanner to hurry up.
+        # Transcodes are moved into the cache when complete, so the file is good even if its size isn't stored yet.
+        if song.type not in settings.NO_TRANSCODE_FORMATS and not os.path.isfile(cache_file_path(song.id)):
+            if settings.TRANSCODE_ON_DEMAND:
+                yield self.stream_live(song)
+            else:
+                yield executor.submit(enqueue_transcodes, [song.id], PLAY_PRIORITY)
+                self.set_status(503)
+                self.set_header("Retry-After", 10)
+                self.finish("503")
+                log.info(u"Track ID %d is not transcoded yet, queued it.", song.id)
+            return
 
-        # See if we got range
-        range_bytes = self.request.headers.get('Range')
-        range_start = 0
-        range_end = None
-        if range_bytes:
-            range_start, range_end = range_bytes[6:].split("-")
-            range_end = None if range_end is "" else int(range_end)
-            range_start = int(range_start)
-
-        # Set streaming headers
-        self.set_status(206)
-        self.set_header("Accept-Ranges", "bytes")
-
-        # Find content length and type
-        if song.type in settings.NO_TRANSCODE_FORMATS:
-            size = song.bytes_len
-            song_file = song.file
-            self.set_header("Content-Type", mimetypes.guess_type("file://"+song.file)[0])
-        else:
-            song_file = os.path.join(
-                settings.MUSIC_CACHE_DIRECTORY,
-                "{}.{}".format(song.id, settings.TRANSCODE_FORMAT))
-            size = song.bytes_tc_len
-            self.set_header("Content-Type", "audio/mpeg")
-
-        # Set end range
-        if not range_end or range_end >= size:
-            range_end = size-1
-
-        # Make sure range_start and range_end are withing size limits
-        if range_start >= size:
-            self.set_status(416)
-            self.finish()
+        # Find the file and its content type
+        song_file, content_type = track_file(song)
+        self.set_header("Content-Type", content_type)
+
+        # Playback starting; keep this one in the cache
+        if song.type not in settings.NO_TRANSCODE_FORMATS and \
+                self.request.headers.get('Range', 'bytes=0-').startswith('bytes=0-'):
+            touch(song.id)
+
+        # Let nginx send the file if it's in front of us. It handles the ranges by itself.
+        if settings.ACCEL_REDIRECT and accel_redirect(self, song_file):
             return
 
-        # Stream out
         try:
-            with open(song_file, 'rb') as f:
-                # Set range headers
-                left = (range_end+1) - range_start
-                self.set_header("Content-Length", left)
-                self.set_header("Content-Range", "bytes {}-{}/{}".format(range_start, range_end, size))
-                self.flush()
-
-                # Forward to starting position and start reading data
-                f.seek(range_start)
-                while left:
-                    r = 16384 if 16384 < left else left
-                    data = yield gen.Task(self.get_data, (f, r))
-                    self.write(data)
-                    left -= r
+            f = open(song_file, 'rb')
         except IOError:
             self.set_status(404)
             self.finish("404")
             log.error(u"Requested track ID %d doesn't exist.", song.id)
             return
 
-        # Flush the last bytes before finishing up.
-        self.flush()
+        with f:
+            size = os.fstat(f.fileno()).st_size
+            etag, last_modified = track_validators(song, size)
+            self.set_header("Accept-Ranges", "bytes")
+            self.set_header("Etag", etag)
+            self.set_header("Last-Modified", last_modified)
+
+            # Client has this version already
+            if self.check_etag_header():
+                self.set_status(304)
+                self.finish()
+                return
+
+            # See if we got range. If-Range asks to ignore it, if the client's copy is not this version.
+            range_header = self.request.headers.get('Range')
+            if_range = self.request.headers.get('If-Range')
+            if if_range and if_range not in (etag, last_modified):
+                range_header = None
+            try:
+                byte_range = parse_range(range_header, size)
+            except ValueError:
+                self.set_status(416)
+                self.set_header("Content-Range", "bytes */{}".format(size))
+                self.finish()
+                return
+
+            if byte_range:
+                range_start, range_end = byte_range
+                self.set_status(206)
+                self.set_header("Content-Range", "bytes {}-{}/{}".format(range_start, range_end, size))
+            else:
+                range_start, range_end = 0, size-1
+
+            # Stream out
+            left = (range_end+1) - range_start
+            self.set_header("Content-Length", left)
+            f.seek(range_start)
+            while left:
+                r = 16384 if 16384 < left else left
+                data = yield gen.Task(self.get_data, (f, r))
+                self.write(data)
+                left -= r
+                try:
+                    yield self.flush()
+                except StreamClosedError:
+                    log.debug(u"Listener for track ID %d went away.", song.id)
+                    return
+
+        try:
+            self.finish()
+        except HTTPOutputError, o:
+            log.error(u"Error while serving track ID %d: %s.", song.id, str(o))
+
+    @gen.coroutine
+    def stream_live(self, song):
+        # Final size is not known yet, so ranges can't be served. Send everything from the start.
+        live = LiveTranscode.get(song.id, song.file)
+        self.set_status(200)
+        self.set_header("Content-Type", "audio/mpeg")
+        self.set_header("Accept-Ranges", "none")
+
+        offset = 0
+        with live.open() as f:
+            while True:
+                yield live.wait(offset)
+                if live.error:
+                    if offset == 0:
+                        self.set_status(500)
+                        self.finish("500")
+                    else:
+                        # Headers are out already; cut the connection so the client sees the response is incomplete
+                        self.request.connection.close()
+                    return
+                if offset >= live.size:
+                    break
+                data = f.read(min(live.size - offset, 65536))
+                offset += len(data)
+                self.write(data)
+                try:
+                    yield self.flush()
+                except StreamClosedError:
+                    log.debug(u"Listener for track ID %d went away.", song.id)
+                    return
+
         try:
             self.finish()
         except HTTPOutputError, o:
-            log.error(u"Error while serving track ID %d: %s.", song_id, str(o))
+            log.error(u"Error while serving track ID %d: %s.", song.id, str(o))
 
     def get_data(self, d, callback):
         return callback(d[0].read(d[1]))
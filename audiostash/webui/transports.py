@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+
+from sockjs.tornado.transports import WebSocketTransport
+
+
+class DeflateWebSocketTransport(WebSocketTransport):
+    """
+    SockJS websocket transport with permessage-deflate. Browsers that support the extension (all current ones)
+    compress messages in both directions; others just get uncompressed messages. Sync messages repeat a lot
+    of the same strings, and compress to a fraction of their size.
+    """
+    def get_compression_options(self):
+        return {}
+
+
+def with_compression(urls):
+    """ Replaces the websocket transport in SockJS router URLs with the compressing one """
+    return [(url, DeflateWebSocketTransport if handler is WebSocketTransport else handler, kwargs)
+            for url, handler, kwargs in urls]
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+# Run with: python -m unittest discover tests
+
+import os
+import imp
+import sys
+import json
+import shutil
+import tempfile
+import datetime
+
+# Use the default settings if there is no local settings.py
+try:
+    from audiostash import settings
+except ImportError:
+    import audiostash
+    settings = imp.load_source(
+        'audiostash.settings', os.path.join(os.path.dirname(audiostash.__file__), 'settings-dist.py'))
+    audiostash.settings = settings
+
+from sqlalchemy import create_engine
+from tornado.testing import AsyncTestCase, gen_test
+from audiostash.common import tables
+from audiostash.common.tables import session_get, Track
+from audiostash.webui.sockethandler import AudioStashSock
+
+
+class RecordingSock(AudioStashSock):
+    def __init__(self):
+        super(RecordingSock, self).__init__(None)
+        self.authenticated = True
+        self.messages = []
+
+    def send(self, message):
+        self.messages.append(json.loads(message))
+
+
+class SyncTest(AsyncTestCase):
+    def setUp(self):
+        super(SyncTest, self).setUp()
+        self.directory = tempfile.mkdtemp()
+        self.page_size = settings.SYNC_PAGE_SIZE
+        settings.SYNC_PAGE_SIZE = 5
+        url = 'sqlite:///' + os.path.join(self.directory, 'test.db')
+        tables.Base.metadata.create_all(create_engine(url))
+        tables.database_init(url)
+
+        # Like the libraries from before the sync cursor had an id: all rows share one timestamp
+        updated = datetime.datetime(2015, 1, 1)
+        s = session_get()
+        for i in range(12):
+            s.add(Track(file=u'/music/{}.mp3'.format(i), title=u'Track {}'.format(i), updated=updated))
+        s.commit()
+        s.close()
+
+    def tearDown(self):
+        settings.SYNC_PAGE_SIZE = self.page_size
+        shutil.rmtree(self.directory)
+        super(SyncTest, self).tearDown()
+
+    def synced_ids(self, sock):
+        return [row['id'] for message in sock.messages for row in message['data']['data']]
+
+    @gen_test
+    def test_request_without_id_gets_every_row(self):
+        sock = RecordingSock()
+        yield sock.on_sync_msg({'query': 'request', 'table': 'track', 'ts': '2000-01-01T00:00:00Z'})
+        self.assertEqual(sorted(self.synced_ids(sock)), range(1, 13))
+        self.assertFalse(sock.messages[-1]['data']['more'])
+
+    @gen_test
+    def test_request_with_id_gets_one_page(self):
+        sock = RecordingSock()
+        yield sock.on_sync_msg({'query': 'request', 'table': 'track', 'ts': '2000-01-01T00:00:00Z', 'id': 0})
+        self.assertEqual(self.synced_ids(sock), range(1, 6))
+        self.assertTrue(sock.messages[-1]['data']['more'])